@@ -0,0 +1,123 @@
+"""Rows per second serializing tasks and timestamps the old (ORM) way and with hqmanager.serializers.
+
+The old way is GET /task before the serializers: one query for the tasks and one more
+for each task's actions. Runs against an in memory sqlite database:
+
+    python benchmarks/serializers.py --tasks 20000 --actions 3
+"""
+import argparse
+import datetime
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from hqlib.sql import Base
+from hqlib.sql.models import Task, TaskStatus, Job, JobStatus, JobTarget, Worker
+from hqmanager import unix_time_millis
+from hqmanager.serializers import task_dicts, millis
+
+
+def legacy_epoch_millis(dt):
+    # unix_time_millis before the epoch was cached
+    epoch = datetime.datetime.utcfromtimestamp(0).replace(tzinfo=dt.tzinfo)
+    return int((dt - epoch).total_seconds() * 1000.0)
+
+
+def orm_task_dicts(query):
+    # How GET /task serialized a page before the serializers, loading each task's actions as it was reached
+    tasks = []
+
+    for task in query:
+        data = {'id': task.id,
+                'name': task.name,
+                'status': task.status.value,
+                'actions': [],
+                'created_at': legacy_epoch_millis(task.created_at),
+                'updated_at': legacy_epoch_millis(task.updated_at)}
+
+        for action in task.actions:
+            action_data = {'processor': action.processor}
+            if action.arguments is not None:
+                action_data['arguments'] = action.arguments
+            data['actions'].append(action_data)
+
+        if task.stopped_at is not None:
+            data['stopped_at'] = legacy_epoch_millis(task.stopped_at)
+
+        tasks.append(data)
+
+    return tasks
+
+
+def populate(session, tasks, actions):
+    action_class = Task.actions.property.mapper.class_
+    now = datetime.datetime.now()
+
+    job = Job(name="benchmark", status=list(JobStatus)[0], datacenter="dc", created_at=now, updated_at=now)
+    worker = Worker(target="benchmark", framework="benchmark", datacenter="dc", tags={}, created_at=now,
+                    updated_at=now)
+    session.add_all([job, worker])
+    session.flush()
+
+    job_target = JobTarget(job_id=job.id, worker_id=worker.id)
+    session.add(job_target)
+    session.flush()
+
+    for i in range(tasks):
+        task = Task(name="task-" + str(i), status=TaskStatus.PENDING, job_target_id=job_target.id,
+                    created_at=now, updated_at=now)
+        for j in range(actions):
+            task.actions.append(action_class(processor="processor-" + str(j), arguments={'n': j}))
+        session.add(task)
+
+    session.commit()
+
+
+def measure(name, rows, function, repeat):
+    best = None
+
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print("%-24s %12.0f rows/sec" % (name, rows / best))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=20000)
+    parser.add_argument('--actions', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    populate(session, args.tasks, args.actions)
+
+    # The query GET /task pages through
+    tasks = session.query(Task).join(JobTarget, Task.job_target_id == JobTarget.id).order_by(Task.id.desc())
+
+    def orm():
+        session.expunge_all()
+        orm_task_dicts(tasks)
+
+    def projected():
+        session.expunge_all()
+        task_dicts(session, tasks)
+
+    measure("tasks orm", args.tasks, orm, args.repeat)
+    measure("tasks projected", args.tasks, projected, args.repeat)
+
+    timestamps = [datetime.datetime.now() - datetime.timedelta(seconds=i) for i in range(args.tasks)]
+
+    measure("timestamps per call", args.tasks, lambda: [legacy_epoch_millis(dt) for dt in timestamps], args.repeat)
+    measure("timestamps cached", args.tasks, lambda: [unix_time_millis(dt) for dt in timestamps], args.repeat)
+    measure("timestamps bulk", args.tasks, lambda: millis(timestamps), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,5 +21,6 @@ setup(
     dependency_links=[
         'git+https://github.com/herqles-io/hq-lib.git#egg=hq-lib-1.0.0'
     ],
-    scripts=['bin/hq-manager']
+    scripts=['bin/hq-manager'],
+    test_suite='tests'
 )
@@ -1,5 +1,6 @@
-import datetime
 import json
+import sys
+from uuid import uuid4
 
 import cherrypy
 from schematics.exceptions import ModelValidationError, ModelConversionError
@@ -8,9 +9,18 @@ from yaml import YAMLError
 
 from hqlib.rabbitmq import RabbitMQ
 from hqlib.sql import SQLDB, Base
+import hqmanager.models
+from hqmanager.progress import repair_progress
 from hqmanager.messaging import *
 import hqmanager.api
-from hqmanager.config import parse_config, BaseConfig, RabbitMQConfig, SQLConfig, PathConfig, LDAPConfig
+from hqmanager.heartbeat import HeartbeatRegistry
+from hqmanager.worker_directory import WorkerDirectory
+from hqmanager.events import EventHub
+from hqmanager.serializers import EPOCH
+from hqmanager.messaging.publisher import PublisherPool
+from hqmanager.messaging.rpc import RPCClient
+from hqmanager.config import parse_config, BaseConfig, RabbitMQConfig, SQLConfig, PathConfig, LDAPConfig, APIConfig, \
+    TokenCacheConfig, MessagingConfig
 from hqlib.daemon import Daemon
 from hqlib.ldap_db import LDAP
 
@@ -23,8 +33,16 @@ class ManagerDaemon(Daemon):
         self.path_config = None
         self.sql_config = None
         self.ldap_config = None
+        self.api_config = None
+        self.token_cache_config = None
+        self.messaging_config = None
         self.rabbitmq_config = None
         self.rabbitmq = None
+        self.publishers = None
+        self.rpc = None
+        self.liveness = None
+        # Subscribers on this manager's own broadcast queues
+        self.broadcasts = []
 
     def get_pid_file(self):
         return self.path_config.pid
@@ -86,6 +104,43 @@ class ManagerDaemon(Daemon):
                 self.logger.error("Could not validate ldap config " + json.dumps(e.message))
                 return False
 
+        try:
+            self.api_config = APIConfig(self.base_config.api or {}, strict=False)
+        except ModelConversionError as e:
+            self.logger.error("Could not create api config " + json.dumps(e.message))
+            return False
+
+        try:
+            self.api_config.validate()
+        except ModelValidationError as e:
+            self.logger.error("Could not validate api config " + json.dumps(e.message))
+            return False
+
+        try:
+            self.token_cache_config = TokenCacheConfig(self.base_config.assignment.get('token_cache') or {},
+                                                       strict=False)
+        except ModelConversionError as e:
+            self.logger.error("Could not create token cache config " + json.dumps(e.message))
+            return False
+
+        try:
+            self.token_cache_config.validate()
+        except ModelValidationError as e:
+            self.logger.error("Could not validate token cache config " + json.dumps(e.message))
+            return False
+
+        try:
+            self.messaging_config = MessagingConfig(self.base_config.messaging or {}, strict=False)
+        except ModelConversionError as e:
+            self.logger.error("Could not create messaging config " + json.dumps(e.message))
+            return False
+
+        try:
+            self.messaging_config.validate()
+        except ModelValidationError as e:
+            self.logger.error("Could not validate messaging config " + json.dumps(e.message))
+            return False
+
         try:
             self.rabbitmq_config = RabbitMQConfig(self.base_config.rabbitmq, strict=False)
         except ModelConversionError as e:
@@ -100,7 +155,7 @@ class ManagerDaemon(Daemon):
 
         return True
 
-    def run(self):
+    def connect_database(self):
         database = SQLDB(self.sql_config.driver, self.sql_config.host, self.sql_config.port, self.sql_config.database,
                          self.sql_config.username, self.sql_config.password, self.sql_config.pool_size)
         database.connect()
@@ -108,11 +163,21 @@ class ManagerDaemon(Daemon):
         with database.session() as session:
             Base.metadata.create_all(bind=session.get_bind())
 
+        return database
+
+    def run(self):
+        database = self.connect_database()
+
         ldap = None
+        ldap_pool = None
 
         if self.ldap_config is not None:
+            # python-ldap is only needed when ldap is configured
+            from hqmanager.ldap_pool import LDAPConnectionPool
+
             ldap = LDAP(self.ldap_config.host, self.ldap_config.domain, self.ldap_config.base_dn,
                         self.ldap_config.bind_username, self.ldap_config.bind_password)
+            ldap_pool = LDAPConnectionPool(ldap, self.ldap_config.pool_size, self.ldap_config.pool_timeout)
 
         hosts = []
         for host in self.rabbitmq_config.hosts:
@@ -139,7 +204,7 @@ class ManagerDaemon(Daemon):
             self.logger.error("Error validating identity config")
             return False
 
-        identity.db_connections(database=database, rabbitmq=self.rabbitmq, ldap=ldap)
+        identity.db_connections(database=database, rabbitmq=self.rabbitmq, ldap=ldap, ldap_pool=ldap_pool)
 
         if 'driver' not in self.base_config.assignment:
             self.logger.error("Assignment Config does not have a driver set")
@@ -157,23 +222,69 @@ class ManagerDaemon(Daemon):
             self.logger.error("Error validating assignment config")
             return False
 
-        assignment.db_connections(database=database, rabbitmq=self.rabbitmq, ldap=ldap)
-
-        RegisterFrameworkSubscriber(self.rabbitmq).start()
-        TaskStatusSubscriber(self.rabbitmq, database).start()
-        TaskLaunchSubscriber(self.rabbitmq, database).start()
-        WorkerRegister(self.rabbitmq, database).start()
-        WorkerReload(self.rabbitmq, database).start()
-        WorkerGet(self.rabbitmq, database).start()
-        Validate(self.rabbitmq, assignment).start()
-        hqmanager.api.setup(self.rabbitmq, database, identity, assignment)
+        assignment.db_connections(database=database, rabbitmq=self.rabbitmq, ldap=ldap, ldap_pool=ldap_pool)
+        assignment.setup_cache(self.token_cache_config.size, self.token_cache_config.ttl)
+
+        manager_id = str(uuid4())
+
+        concurrency = self.messaging_config.concurrency
+        publishers = PublisherPool(self.rabbitmq, self.messaging_config.publisher_channels,
+                                   self.messaging_config.publisher_confirms)
+        self.publishers = publishers
+        rpc = RPCClient(self.rabbitmq, publishers, self.messaging_config.rpc_timeout)
+        rpc.start()
+        self.rpc = rpc
+
+        RegisterFrameworkSubscriber(self.rabbitmq, concurrency.get('framework_register', 1), publishers).start()
+        # The API has a request thread for every waiter on top of api.threads, so waiters never starve other requests
+        events = EventHub(publishers, manager_id, waiters=self.api_config.events_waiters)
+        self.start_broadcast(TaskEvents(self.rabbitmq, events, manager_id))
+        TaskStatusSubscriber(self.rabbitmq, database, concurrency.get('task_status', 1),
+                             self.messaging_config.status_batch_size,
+                             self.messaging_config.status_batch_window / 1000.0, publishers, events).start()
+        heartbeats = HeartbeatRegistry(self.messaging_config.heartbeat_timeout)
+        self.start_broadcast(WorkerHeartbeat(self.rabbitmq, heartbeats, manager_id))
+
+        liveness = WorkerLiveness(rpc, heartbeats, self.messaging_config.liveness_checks,
+                                  self.messaging_config.liveness_timeout)
+        self.liveness = liveness
+        TaskLaunchSubscriber(self.rabbitmq, database, liveness, concurrency.get('task_launch', 1), publishers,
+                             events, self.messaging_config.launch_prefetch).start()
+        TaskLaunchBatchSubscriber(self.rabbitmq, database, liveness, concurrency.get('task_launch_batch', 1),
+                                  publishers, events, self.messaging_config.launch_prefetch).start()
+        directory = WorkerDirectory(database, publishers, manager_id)
+        directory.load()
+        if self.messaging_config.worker_directory_reload > 0:
+            directory.reload_every(self.messaging_config.worker_directory_reload)
+        self.start_broadcast(WorkerChanged(self.rabbitmq, directory, manager_id))
+        WorkerRegister(self.rabbitmq, database, directory, concurrency.get('worker_register', 1),
+                       self.messaging_config.register_batch_size,
+                       self.messaging_config.register_batch_window / 1000.0, publishers).start()
+        WorkerReload(self.rabbitmq, database, directory, concurrency.get('worker_reload', 1), publishers).start()
+        WorkerGet(self.rabbitmq, directory, concurrency.get('worker_get', 1), publishers).start()
+        Validate(self.rabbitmq, assignment, concurrency.get('security_validate', 1), publishers).start()
+        self.start_broadcast(InvalidateTokens(self.rabbitmq, assignment, manager_id))
+        hqmanager.api.setup(self.rabbitmq, database, rpc, identity, assignment, heartbeats, directory, events,
+                            self.api_config)
 
         return True
 
+    def start_broadcast(self, subscriber):
+        subscriber.start()
+        self.broadcasts.append(subscriber)
+
     def on_shutdown(self, signum=None, frame=None):
         cherrypy.engine.exit()
         for subscriber in list(self.rabbitmq.active_subscribers):
             subscriber.stop()
+        for subscriber in self.broadcasts:
+            subscriber.stop()
+        if self.liveness is not None:
+            self.liveness.stop()
+        if self.rpc is not None:
+            self.rpc.stop()
+        if self.publishers is not None:
+            self.publishers.close()
 
     def on_reload(self, signum=None, frame=None):
         pass
@@ -181,10 +292,28 @@ class ManagerDaemon(Daemon):
 
 def main(args):
     daemon = ManagerDaemon(args)
+
+    if args.repair_progress:
+        repair(daemon)
+        return
+
     daemon.start()
 
 
+def repair(daemon):
+    if not daemon.setup():
+        sys.exit(1)
+
+    database = daemon.connect_database()
+
+    with database.session() as session:
+        jobs = repair_progress(session)
+        session.commit()
+
+    daemon.logger.info("Recounted progress of " + str(jobs) + " jobs")
+
+
 def unix_time_millis(dt):
-    epoch = datetime.datetime.utcfromtimestamp(0).replace(tzinfo=dt.tzinfo)
-    delta = dt - epoch
+    # Same as subtracting an epoch in dt's own timezone without building one per call
+    delta = dt.replace(tzinfo=None) - EPOCH
     return int(delta.total_seconds() * 1000.0)
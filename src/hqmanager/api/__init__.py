@@ -2,15 +2,16 @@ import json
 
 import cherrypy
 
-from hqlib.rabbitmq.rpc import RPCPublisher
-
 
 class MainController(object):
     exposed = True
 
-    def __init__(self, rabbitmq, database):
+    def __init__(self, rabbitmq, database, rpc, assignment=None, local_auth=False):
         self.rabbitmq = rabbitmq
+        self.rpc = rpc
         self.database = database
+        self.assignment = assignment
+        self.local_auth = local_auth
 
     def index(self):
         return "Manager Index"
@@ -60,36 +61,51 @@ class MainController(object):
 
         token = headers['X-Auth-Token']
 
-        publisher = RPCPublisher(self.rabbitmq, "security", "validate")
+        if self.local_auth:
+            data = self.assignment.validate_request(token, permission)
+        else:
+            data = self.rpc_auth(token, permission)
+
+        if data['code'] != 200:
+            raise cherrypy.HTTPError(data['code'], data['error'])
 
+        cherrypy.request.user = {'id': data['user']['id'], 'name': data['user']['name']}
+
+    def rpc_auth(self, token, permission=None):
         output = {'token': token}
 
         if permission is not None:
             output['permission'] = permission
 
-        correlation_id = publisher.publish(output)
-
-        if correlation_id is None:
-            raise cherrypy.HTTPError(500, "Error publishing auth rpc")
-
-        data = publisher.get_data(correlation_id)
+        data = self.rpc.call("security", "validate", output)
 
         if data is None:
             raise cherrypy.HTTPError(500, "Did not hear back from a manager - security validate")
 
-        if data['code'] != 200:
-            raise cherrypy.HTTPError(data['code'], data['error'])
+        return data
 
-        cherrypy.request.user = {'id': data['user']['id'], 'name': data['user']['name']}
 
+# The MainController requests are authenticated with, set by setup()
+auth_controller = None
 
-def setup(rabbitmq, database, identity, assignment):
 
-    dispatcher = cherrypy.dispatch.RoutesDispatcher()
+def auth(permission=None, debug=False):
+    auth_controller.auth(permission, debug)
+
+
+# Registered on import so the controller modules can use it before setup() runs
+cherrypy.tools.auth = cherrypy.Tool("on_start_resource", auth)
 
-    main = MainController(rabbitmq, database)
 
-    cherrypy.tools.auth = cherrypy.Tool("on_start_resource", main.auth)
+def setup(rabbitmq, database, rpc, identity, assignment, heartbeats, directory, events, api_config):
+    global auth_controller
+
+    dispatcher = cherrypy.dispatch.RoutesDispatcher()
+
+    main = MainController(rabbitmq, database, rpc, assignment, api_config.local_auth)
+    auth_controller = main
+    from hqmanager.api import query_count
+    query_count.install()
 
     dispatcher.connect('main', '/', controller=main, action='index')
     dispatcher.connect('main', '/_ping', controller=main, action='ping')
@@ -97,15 +113,16 @@ def setup(rabbitmq, database, identity, assignment):
 
     setup_user(main, dispatcher, identity, assignment)
 
-    setup_job(database, main, dispatcher)
+    setup_job(database, events, api_config, main, dispatcher)
 
-    setup_task(database, main, dispatcher)
+    setup_task(database, api_config, main, dispatcher)
 
-    setup_worker(database, main, dispatcher)
+    setup_worker(database, heartbeats, directory, main, dispatcher)
 
     conf = {
         '/': {
             'request.dispatch': dispatcher,
+            'tools.query_count.on': True,
             'tools.response_headers.on': True,
             'tools.response_headers.headers': [('Content-Type', 'application/json')]
         }
@@ -116,13 +133,15 @@ def setup(rabbitmq, database, identity, assignment):
     cherrypy.config.update({'engine.autoreload.on': False,
                             'error_page.default': main.jsonify_error,
                             'engine.timeout_monitor.on': False,
+                            # Every waiting events request holds a thread of its own
+                            'server.thread_pool': api_config.threads + api_config.events_waiters,
                             'server.socket_port': 8080})
     cherrypy.engine.start()
 
 
-def setup_worker(database, main_controller, dispatcher):
+def setup_worker(database, heartbeats, directory, main_controller, dispatcher):
     from hqmanager.api.worker import WorkerAPIController
-    worker = WorkerAPIController(database)
+    worker = WorkerAPIController(database, heartbeats, directory)
 
     dispatcher.connect('worker:get', '/worker', controller=worker, action='GET', conditions=dict(method=['GET']))
 
@@ -131,18 +150,27 @@ def setup_worker(database, main_controller, dispatcher):
     dispatcher.connect('worker:405', '/worker', controller=main_controller, action='method_not_allowed')
 
 
-def setup_job(database, main_controller, dispatcher):
+def setup_job(database, events, api_config, main_controller, dispatcher):
     from hqmanager.api.job import JobAPIController
-    job = JobAPIController(database)
+    job = JobAPIController(database, events, api_config.job_cache_size, api_config.events_timeout,
+                           api_config.page_size, api_config.max_page_size)
+
+    dispatcher.connect('job:list', '/job', controller=job, action='list', conditions=dict(method=['GET']))
 
     dispatcher.connect('job:get', '/job/{job_id}', controller=job, action='GET', conditions=dict(method=['GET']))
 
+    dispatcher.connect('job:events', '/job/{job_id}/events', controller=job, action='events',
+                       conditions=dict(method=['GET']))
+
+    dispatcher.connect('job:events:405', '/job/{job_id}/events', controller=main_controller,
+                       action='method_not_allowed')
+
     dispatcher.connect('job:405', '/job', controller=main_controller, action='method_not_allowed')
 
 
-def setup_task(database, main_controller, dispatcher):
+def setup_task(database, api_config, main_controller, dispatcher):
     from hqmanager.api.task import TaskAPIController
-    task = TaskAPIController(database)
+    task = TaskAPIController(database, api_config.page_size, api_config.max_page_size)
 
     dispatcher.connect('task', '/task', controller=task, action='GET', conditions=dict(method=['GET']))
     dispatcher.connect('task:single', '/task/{task_id}', controller=task, action='GET', conditions=dict(method=['GET']))
@@ -183,6 +211,17 @@ def setup_user(main_controller, dispatcher, identity, assignment):
     dispatcher.connect('user:permission:405', '/user/permission', controller=main_controller,
                        action='method_not_allowed')
 
+    # Flush cached tokens and permissions of every user, outside /user so no username can collide with it
+    dispatcher.connect('user:cache:delete', '/_cache/user', controller=user, action='flush_cache',
+                       conditions=dict(method=['DELETE']))
+    dispatcher.connect('user:cache:405', '/_cache/user', controller=main_controller, action='method_not_allowed')
+
+    # Flush cached tokens and permissions of one user
+    dispatcher.connect('user:cache:user:delete', '/_cache/user/{username}', controller=user, action='flush_cache',
+                       conditions=dict(method=['DELETE']))
+    dispatcher.connect('user:cache:user:405', '/_cache/user/{username}', controller=main_controller,
+                       action='method_not_allowed')
+
     # Get User
     dispatcher.connect('user:get', '/user/{username}', controller=user, action='get',
                        conditions=dict(method=['GET']))
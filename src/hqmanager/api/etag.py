@@ -0,0 +1,37 @@
+import json
+
+import cherrypy
+
+
+def make_etag(*parts):
+    return '"' + "-".join(str(part) for part in parts) + '"'
+
+
+def not_modified(etag):
+    """Send etag with the response and return True if the client's If-None-Match already has it.
+
+    When it does the response is turned into a 304, cherrypy drops the body of a 304 so the caller can
+    return anything, not_modified_body() is there for handlers that return raw bytes.
+    """
+    cherrypy.response.headers['ETag'] = etag
+    header = cherrypy.request.headers.get('If-None-Match')
+
+    if header is None:
+        return False
+
+    tags = [tag.strip() for tag in header.split(',')]
+
+    if etag not in tags and '*' not in tags:
+        return False
+
+    cherrypy.response.status = 304
+    return True
+
+
+def not_modified_body():
+    return b""
+
+
+def json_body(data):
+    """Serialize a response once so the same bytes can be cached and sent again."""
+    return json.dumps(data).encode('utf-8')
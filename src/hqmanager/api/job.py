@@ -1,51 +1,144 @@
 import cherrypy
 import logging
-from hqlib.sql.models import Job
-from hqmanager import unix_time_millis
+import datetime
+from hqlib.sql.models import Job, JobStatus
+from hqmanager.cache import TTLCache
+from hqmanager.events import TooManyWaitersException
+from hqmanager.serializers import job_dict, job_version, job_summaries
+from hqmanager.api.etag import make_etag, not_modified, not_modified_body, json_body
 
 
 class JobAPIController(object):
 
     exposed = True
 
-    def __init__(self, database):
+    def __init__(self, database, events, cache_size=1000, events_timeout=30, page_size=20, max_page_size=100):
         self.logger = logging.getLogger("hq.manager.api.job")
         self.database = database
+        self.events = events
+        self.events_timeout = events_timeout
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        # job id -> (etag, body) for jobs that have stopped and so can no longer change
+        self.finished = TTLCache(cache_size)
 
     @cherrypy.tools.json_out()
+    @cherrypy.tools.auth(permission="herqles.job.get")
+    def list(self, ids=None, status=None, since=None, until=None, before=None, limit=None):
+        """Summaries of many jobs at once, either the ids (comma separated or repeated) or a filtered page of jobs.
+
+        since and until bound created_at in unix millis, before is the cursor from the previous page.
+        """
+        try:
+            per_page = min(int(limit or self.page_size), self.max_page_size)
+            before = int(before) if before is not None else None
+            since = datetime.datetime.utcfromtimestamp(int(since) / 1000.0) if since is not None else None
+            until = datetime.datetime.utcfromtimestamp(int(until) / 1000.0) if until is not None else None
+
+            if ids is not None:
+                # ?ids=1,2 arrives as a string, ?ids=1&ids=2 as a list, and the two can be mixed
+                if not isinstance(ids, list):
+                    ids = [ids]
+                ids = sorted(set(int(job_id) for value in ids for job_id in value.split(',') if job_id.strip() != ''))
+        except ValueError:
+            raise cherrypy.HTTPError(400, "ids, before, limit, since and until must be integers")
+
+        if per_page < 1:
+            raise cherrypy.HTTPError(400, "limit must be at least 1")
+
+        if status is not None:
+            try:
+                status = JobStatus(status)
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Unknown job status "+status)
+
+        with self.database.session() as session:
+            jobs = session.query(Job)
+
+            if ids is not None:
+                if len(ids) > self.max_page_size:
+                    raise cherrypy.HTTPError(400, "At most "+str(self.max_page_size)+" ids can be asked for at once")
+
+                jobs = jobs.filter(Job.id.in_(ids))
+                per_page = len(ids)
+
+            if status is not None:
+                jobs = jobs.filter(Job.status == status)
+
+            if since is not None:
+                jobs = jobs.filter(Job.created_at >= since)
+
+            if until is not None:
+                jobs = jobs.filter(Job.created_at < until)
+
+            if before is not None:
+                jobs = jobs.filter(Job.id < before)
+
+            summaries = job_summaries(session, jobs.order_by(Job.id.desc()).limit(per_page))
+
+        next_cursor = None
+        if ids is None and len(summaries) == per_page:
+            next_cursor = summaries[-1]['id']
+
+        return {"jobs": summaries, "next": next_cursor}
+
     @cherrypy.tools.auth(permission="herqles.job.get")
     def GET(self, job_id):
 
+        cached = self.finished.get(job_id)
+
+        if cached is not None:
+            (etag, body) = cached
+
+            if not_modified(etag):
+                return not_modified_body()
+
+            return body
+
         with self.database.session() as session:
-            job = session.query(Job).filter(Job.id == job_id).first()
+            version = job_version(session, job_id)
 
-            if job is None:
+            if version is None:
                 raise cherrypy.HTTPError(404, "Unknown Job ID "+job_id)
 
-            data = {'id': job.id,
-                    'name': job.name,
-                    'status': job.status.value,
-                    'datacenter': job.datacenter,
-                    'targets': [],
-                    'created_at': unix_time_millis(job.created_at),
-                    'updated_at': unix_time_millis(job.updated_at)}
-
-            for job_target in job.targets:
-                target_data = {
-                    'target': job_target.worker.target,
-                    'tasks': []
-                }
-                if job_target.tags is not None:
-                    target_data['tags'] = job_target.tags
-                for task in job_target.tasks:
-                    task_data = {
-                        'id': task.id,
-                        'status': task.status.value
-                    }
-                    target_data['tasks'].append(task_data)
-                data['targets'].append(target_data)
-
-            if job.stopped_at is not None:
-                data['stopped_at'] = unix_time_millis(job.stopped_at)
-
-            return data
+            (version, finished) = version
+            etag = make_etag(job_id, *version)
+
+            # Only build the job when the client does not already have this version
+            if not_modified(etag):
+                return not_modified_body()
+
+            data = job_dict(session, job_id)
+
+        if data is None:
+            raise cherrypy.HTTPError(404, "Unknown Job ID "+job_id)
+
+        body = json_body(data)
+
+        if finished:
+            self.finished.set(job_id, (etag, body))
+
+        return body
+
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.auth(permission="herqles.job.get")
+    def events(self, job_id, since=None, timeout=None):
+        """Long poll for the task status changes of a job after the since version.
+
+        Without since the current version is returned straight away to start from. Versions
+        are opaque and only mean something to the Manager that handed them out.
+        """
+        try:
+            timeout = min(float(timeout or self.events_timeout), self.events_timeout)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "timeout must be a number")
+
+        if since is None:
+            return {"events": [], "version": self.events.latest(), "reset": False}
+
+        try:
+            (events, reset, version) = self.events.wait(job_id, since, timeout)
+        except TooManyWaitersException:
+            raise cherrypy.HTTPError(503, "Too many requests waiting on events, retry later")
+
+        return {"events": events, "version": version, "reset": reset}
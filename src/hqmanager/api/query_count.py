@@ -0,0 +1,46 @@
+import threading
+
+import cherrypy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+counter = threading.local()
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    counter.queries = getattr(counter, 'queries', 0) + 1
+
+
+def queries():
+    """The number of sql statements run on this thread since the last reset."""
+    return getattr(counter, 'queries', 0)
+
+
+def reset():
+    counter.queries = 0
+
+
+def add_header():
+    if 'X-Debug' in cherrypy.request.headers:
+        cherrypy.response.headers['X-Query-Count'] = str(queries())
+
+
+class QueryCountTool(cherrypy.Tool):
+    """Counts the sql statements a request runs.
+
+    Requests sent with an X-Debug header get the count back in X-Query-Count.
+    """
+
+    def __init__(self):
+        cherrypy.Tool.__init__(self, 'on_start_resource', reset)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach('before_finalize', add_header)
+
+
+def install():
+    if not event.contains(Engine, "before_cursor_execute", count_query):
+        event.listen(Engine, "before_cursor_execute", count_query)
+
+    cherrypy.tools.query_count = QueryCountTool()
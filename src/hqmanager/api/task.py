@@ -2,25 +2,34 @@ import cherrypy
 import logging
 from hqlib.sql.models import Task, JobTarget
 from hqmanager import unix_time_millis
+from hqmanager.serializers import task_dicts
+from hqmanager.api.etag import make_etag, not_modified
 
 
 class TaskAPIController(object):
 
     exposed = True
 
-    def __init__(self, database):
+    def __init__(self, database, page_size=20, max_page_size=100):
         self.logger = logging.getLogger("hq.manager.api.task")
         self.database = database
+        self.page_size = page_size
+        self.max_page_size = max_page_size
 
     @cherrypy.tools.json_out()
     @cherrypy.tools.auth(permission="herqles.task.get")
-    def GET(self, task_id=None, job_id=None, page=1):
+    def GET(self, task_id=None, job_id=None, page=None, before=None, limit=None):
 
         if task_id is None:
-            tasks = []
+            try:
+                per_page = min(int(limit or self.page_size), self.max_page_size)
+                before = int(before) if before is not None else None
+                page = int(page) if page is not None else None
+            except ValueError:
+                raise cherrypy.HTTPError(400, "before, limit and page must be integers")
 
-            per_page = 20
-            offset = (int(page) - 1) * per_page
+            if per_page < 1:
+                raise cherrypy.HTTPError(400, "limit must be at least 1")
 
             with self.database.session() as session:
                 task_objects = session.query(Task).join(JobTarget, Task.job_target_id == JobTarget.id)
@@ -28,50 +37,43 @@ class TaskAPIController(object):
                 if job_id is not None:
                     task_objects = task_objects.filter(JobTarget.job_id == job_id)
 
-                task_objects = task_objects.order_by(Task.id.desc()).limit(per_page).offset(offset)
+                # Seek past the cursor on the primary key instead of skipping rows, page is kept for older clients
+                if before is not None:
+                    task_objects = task_objects.filter(Task.id < before)
 
-                for task in task_objects:
-                    data = {'id': task.id,
-                            'name': task.name,
-                            'status': task.status.value,
-                            'actions': [],
-                            'created_at': unix_time_millis(task.created_at),
-                            'updated_at': unix_time_millis(task.updated_at)}
+                task_objects = task_objects.order_by(Task.id.desc()).limit(per_page)
 
-                    for action in task.actions:
-                        action_data = {'processor': action.processor}
-                        if action.arguments is not None:
-                            action_data['arguments'] = action.arguments
-                        data['actions'].append(action_data)
+                if before is None and page is not None:
+                    task_objects = task_objects.offset((max(page, 1) - 1) * per_page)
 
-                    if task.stopped_at is not None:
-                        data['stopped_at'] = unix_time_millis(task.stopped_at)
+                tasks = task_dicts(session, task_objects)
 
-                    tasks.append(data)
+            # The cursor for the next page, None once there are no more tasks
+            next_cursor = None
+            if len(tasks) == per_page:
+                next_cursor = tasks[-1]['id']
 
-            return {"tasks": tasks}
+            return {"tasks": tasks, "next": next_cursor}
         else:
 
             with self.database.session() as session:
-                task = session.query(Task).filter(Task.id == task_id).first()
+                row = session.query(Task.updated_at, Task.status).filter(Task.id == task_id).first()
 
-                if task is None:
+                if row is None:
                     return {}
 
-                data = {'id': task.id,
-                        'name': task.name,
-                        'status': task.status.value,
-                        'actions': [],
-                        'created_at': unix_time_millis(task.created_at),
-                        'updated_at': unix_time_millis(task.updated_at)}
+                (updated_at, status) = row
 
-                for action in task.actions:
-                    action_data = {'processor': action.processor}
-                    if action.arguments is not None:
-                        action_data['arguments'] = action.arguments
-                    data['actions'].append(action_data)
+                # Only build the task when the client does not already have this version, a 304 has no body.
+                # The status is part of it in case the database stores updated_at in whole seconds. A task
+                # without updated_at has no version to compare and is always sent
+                if updated_at is not None and \
+                        not_modified(make_etag(task_id, unix_time_millis(updated_at), status.value)):
+                    return None
 
-                if task.stopped_at is not None:
-                    data['stopped_at'] = unix_time_millis(task.stopped_at)
+                tasks = task_dicts(session, session.query(Task).filter(Task.id == task_id))
 
-                return data
+                if len(tasks) == 0:
+                    return {}
+
+                return tasks[0]
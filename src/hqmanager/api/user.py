@@ -69,6 +69,13 @@ class UserAPIController(object):
 
         return output
 
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.auth(permission="herqles.user.cache.delete")
+    def flush_cache(self, username=None):
+        self.assignment.invalidate(username)
+
+        return {'username': username, 'flushed': True}
+
     @cherrypy.tools.json_out()
     @cherrypy.tools.json_in()
     def get_token(self):
@@ -140,4 +147,6 @@ class UserAPIController(object):
         if self.assignment.has_permission_user(username, permission, exact=True) is False:
             raise cherrypy.HTTPError(409, "User does not have permission "+permission)
 
+        self.assignment.remove_permission(username, permission)
+
         return data
@@ -2,47 +2,39 @@ import cherrypy
 import logging
 from hqlib.sql.models import Worker
 import datetime
-from hqmanager import unix_time_millis
+from hqmanager.serializers import worker_dicts
 
 
 class WorkerAPIController(object):
 
     exposed = True
 
-    def __init__(self, database):
+    def __init__(self, database, heartbeats, directory):
         self.logger = logging.getLogger("hq.manager.api.worker")
         self.database = database
+        self.heartbeats = heartbeats
+        self.directory = directory
 
     @cherrypy.tools.json_out()
     @cherrypy.tools.auth(permission="herqles.worker.get")
-    def GET(self, framework=None, target=None, datacenter=None):
+    def GET(self, framework=None, target=None, datacenter=None, tag=None):
 
-        workers = []
+        # tag=key:value can be repeated, a worker has to have every tag asked for
+        if tag is None:
+            tag = []
+        elif not isinstance(tag, list):
+            tag = [tag]
 
-        with self.database.session() as session:
-            worker_objects = session.query(Worker).filter(Worker.deleted == False).order_by(Worker.id.asc())
-
-            if framework is not None:
-                worker_objects = worker_objects.filter(Worker.framework == framework)
-
-            if target is not None:
-                worker_objects = worker_objects.filter(Worker.target == target)
-
-            if datacenter is not None:
-                worker_objects = worker_objects.filter(Worker.datacenter == datacenter)
+        tags = []
+        for predicate in tag:
+            if ':' not in predicate:
+                raise cherrypy.HTTPError(400, "tag must look like key:value")
 
-            for worker in worker_objects:
-                data = {'id': worker.id,
-                        'target': worker.target,
-                        'framework': worker.framework,
-                        'datacenter': worker.datacenter,
-                        'tags': worker.tags,
-                        'created_at': unix_time_millis(worker.created_at),
-                        'updated_at': unix_time_millis(worker.updated_at)}
+            tags.append(tuple(predicate.split(':', 1)))
 
-                workers.append(data)
+        workers = self.directory.find(framework=framework, datacenter=datacenter, target=target, tags=tags)
 
-        return {"workers": workers}
+        return {"workers": worker_dicts(workers, self.heartbeats)}
 
     @cherrypy.tools.json_out()
     @cherrypy.tools.auth(permission="herqles.worker.delete")
@@ -59,4 +51,7 @@ class WorkerAPIController(object):
             worker.deleted = True
             worker.deleted_at = datetime.datetime.now()
             session.commit()
+            self.heartbeats.remove(worker.target, worker.framework)
+            self.directory.remove(worker.id)
+            self.directory.changed(worker.id)
             return {str(worker.id): "deleted"}
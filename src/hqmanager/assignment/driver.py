@@ -1,4 +1,13 @@
+import datetime
 from abc import ABCMeta, abstractmethod
+from collections import namedtuple
+
+from hqlib.rabbitmq.routing import Publisher as RoutingPublisher
+from hqmanager import unix_time_millis
+from hqmanager.cache import TTLCache
+
+# What a valid token resolves to. expire_at is in unix millis and permissions is a PermissionTrie.
+TokenAssignment = namedtuple('TokenAssignment', ['id', 'username', 'expire_at', 'permissions'])
 
 
 class AssignmentAbstractDriver(object):
@@ -7,6 +16,8 @@ class AssignmentAbstractDriver(object):
 
     def __init__(self):
         self.config = None
+        self.rabbitmq = None
+        self.token_cache = TTLCache(10000, 60)
 
     @abstractmethod
     def db_connections(self, **kwargs):
@@ -56,6 +67,11 @@ class AssignmentAbstractDriver(object):
     def validate_token(self, token):
         return False
 
+    @abstractmethod
+    def resolve_token(self, token):
+        """Resolve a valid token to a TokenAssignment in one call, None if it is invalid or expired."""
+        return None
+
     @abstractmethod
     def create_assignment(self, username):
         pass
@@ -64,6 +80,52 @@ class AssignmentAbstractDriver(object):
     def has_assignment(self, username):
         pass
 
+    def setup_cache(self, size, ttl):
+        self.token_cache = TTLCache(size, ttl)
+
+    def validate_request(self, token, permission=None):
+        """Check a token (and optionally a permission) for an incoming request.
+
+        Returns the same payload the security validate rpc replies with so the
+        api can call this directly instead of going through rabbitmq.
+        """
+        assignment = self.token_cache.get(token)
+
+        # expire_at is computed from naive local datetimes by the drivers so compare it the same way
+        if assignment is None or (assignment.expire_at is not None and
+                                  assignment.expire_at < unix_time_millis(datetime.datetime.now())):
+            assignment = self.resolve_token(token)
+
+            if assignment is None:
+                self.token_cache.delete(token)
+                return {"code": 403, "error": "Invalid API Token"}
+
+            self.token_cache.set(token, assignment)
+
+        if permission is not None:
+            if not self.permission_granted(assignment.username, assignment.permissions, permission):
+                return {"code": 403, "error": "Invalid user permissions"}
+
+        return {"code": 200, "user": {'id': assignment.id, 'name': assignment.username}}
+
+    def permission_granted(self, username, permissions, permission, exact=False):
+        return permissions.matches(permission, exact)
+
+    def invalidate(self, username=None):
+        """Drop cached tokens of a user (or of every user) on all managers."""
+        self.invalidate_local(username)
+
+        if self.rabbitmq is not None:
+            publisher = RoutingPublisher(self.rabbitmq, "security", "invalidate")
+            publisher.publish({'username': username})
+            publisher.close()
+
+    def invalidate_local(self, username=None):
+        if username is None:
+            self.token_cache.clear()
+        else:
+            self.token_cache.delete_where(lambda token, assignment: assignment.username == username)
+
 
 class AssignmentMissingDBConnectionException(Exception):
 
@@ -1,15 +1,21 @@
 import logging
 import json
+import datetime
 
 import ldap as ldap_module
 from schematics.exceptions import ModelValidationError, ModelConversionError
 from schematics.models import Model
-from schematics.types import StringType
+from schematics.types import StringType, IntType
 from schematics.types.compound import DictType, ListType
 
 import hqmanager.assignment.sql_driver
-from hqlib.sql.models import UserAssignment
-from hqmanager.assignment.driver import AssignmentMissingDBConnectionException
+from hqlib.sql.models import UserAssignment, Token
+from hqmanager.assignment.driver import AssignmentAbstractDriver, AssignmentMissingDBConnectionException, \
+    TokenAssignment
+from hqmanager.assignment.permission import PermissionTrie
+from hqmanager.ldap_pool import LDAPConnectionPool
+from hqmanager.cache import TTLCache
+from hqmanager import unix_time_millis
 
 class AssignmentDriver(hqmanager.assignment.sql_driver.AssignmentDriver):
     def __init__(self):
@@ -17,6 +23,8 @@ class AssignmentDriver(hqmanager.assignment.sql_driver.AssignmentDriver):
         self.logger = logging.getLogger("hq.manager.assignment.ldap")
         self.database = None
         self.ldap = None
+        self.ldap_pool = None
+        self.permission_cache = None
 
     def db_connections(self, **kwargs):
         if 'database' not in kwargs:
@@ -30,11 +38,16 @@ class AssignmentDriver(hqmanager.assignment.sql_driver.AssignmentDriver):
 
         self.database = kwargs['database']
         self.ldap = kwargs['ldap']
+        self.ldap_pool = kwargs.get('ldap_pool') or LDAPConnectionPool(self.ldap)
+        self.rabbitmq = kwargs.get('rabbitmq')
 
     def validate_config(self, config):
 
         class ConfigValidator(Model):
             mapping = DictType(ListType(StringType()), required=True)
+            cache_size = IntType(default=10000, min_value=1)
+            cache_ttl = IntType(default=300, min_value=0)
+            negative_cache_ttl = IntType(default=60, min_value=0)
 
         try:
             self.config = ConfigValidator(config, strict=False)
@@ -48,6 +61,9 @@ class AssignmentDriver(hqmanager.assignment.sql_driver.AssignmentDriver):
             self.logger.error("Could not validate config for assignment LDAP driver " + json.dumps(e.message))
             return False
 
+        # username -> (permissions, PermissionTrie) resolved from the user's groups
+        self.permission_cache = TTLCache(self.config.cache_size, self.config.cache_ttl)
+
         return True
 
     def get_assignment_id(self, username):
@@ -65,12 +81,9 @@ class AssignmentDriver(hqmanager.assignment.sql_driver.AssignmentDriver):
 
     # only create assignment if user is in LDAP
     def create_assignment(self, username):
-        connection = self.ldap.connection_as(self.ldap.bind_username, self.ldap.bind_password)
-
         criteria = "(&(samaccountname=" + username + "))"
         attributes = ['displayName']
-        result = connection.search_s(self.ldap.base_dn, ldap_module.SCOPE_SUBTREE, criteria, attributes)[0][0]
-        connection.unbind()
+        result = self.ldap_pool.search_s(self.ldap.base_dn, ldap_module.SCOPE_SUBTREE, criteria, attributes)[0][0]
 
         if result is None:
             self.logger.warning("Trying to create assignment for user " + username + " but they are not in ldap.")
@@ -86,52 +99,60 @@ class AssignmentDriver(hqmanager.assignment.sql_driver.AssignmentDriver):
         pass
 
     def has_permission_user(self, username, permission, exact=False):
-        perms = self.get_permissions(username)
-
-        for perm in perms:
-            perm_split = perm.split(".")
-            permission_split = permission.split(".")
-
-            matches = True
-
-            if len(permission_split) >= len(perm_split):
-                for i in range(0, len(perm_split)):
-                    if perm_split[i] == permission_split[i]:
-                        continue
-                    elif perm_split[i] == "*" and exact is False:
-                        continue
-                    else:
-                        matches = False
-                        break
-            else:
-                matches = False
+        (permissions, trie) = self.resolve_permissions(username)
+        return trie.matches(permission, exact)
 
-            if matches is False:
-                continue
+    # There is no admin user with ldap assignment, skip the sql driver's check
+    def permission_granted(self, username, permissions, permission, exact=False):
+        return AssignmentAbstractDriver.permission_granted(self, username, permissions, permission, exact)
+
+    # Permissions live in ldap so only the token and assignment come from sql
+    def resolve_token(self, token):
+        with self.database.session() as session:
+            row = session.query(UserAssignment.id, UserAssignment.username, Token.updated_at). \
+                join(Token, Token.id == UserAssignment.token_id). \
+                filter(Token.token == token).first()
+
+        if row is None:
+            return None
 
-            return True
+        (assignment_id, username, updated_at) = row
 
-        return False
+        expire_at = unix_time_millis(updated_at + datetime.timedelta(hours=3))
+        if expire_at < unix_time_millis(datetime.datetime.now()):
+            return None
 
-    def has_permission_token(self, token, permission, exact=False):
-        return self.has_permission_user(self.get_username_from_token(token), permission, exact)
+        return TokenAssignment(assignment_id, username, expire_at, self.resolve_permissions(username)[1])
 
     def add_permission(self, username, permission):
         pass
 
     def get_permissions(self, username):
+        (permissions, trie) = self.resolve_permissions(username)
+        return list(permissions)
 
-        permissions = []
+    def resolve_permissions(self, username):
+        cached = self.permission_cache.get(username)
 
-        connection = self.ldap.connection_as(self.ldap.bind_username, self.ldap.bind_password)
+        if cached is not None:
+            return cached
 
         criteria = "(&(samaccountname=" + username + "))"
         attributes = ['memberOf']
-        result = connection.search_s(self.ldap.base_dn, ldap_module.SCOPE_SUBTREE, criteria,
-                                     attributes)[0][1]['memberOf']
-        connection.unbind()
+        results = self.ldap_pool.search_s(self.ldap.base_dn, ldap_module.SCOPE_SUBTREE, criteria, attributes)
+
+        # Entries without a dn are search referrals, not the user
+        entries = [attrs for (dn, attrs) in results if dn is not None]
 
-        for group in result:
+        if len(entries) == 0:
+            self.logger.warning("Resolving permissions for user " + username + " but they are not in ldap.")
+            resolved = ((), PermissionTrie())
+            self.permission_cache.set(username, resolved, self.config.negative_cache_ttl)
+            return resolved
+
+        permissions = []
+
+        for group in entries[0].get('memberOf', []):
             group = group.replace(self.ldap.base_dn, "")[:-1]
             if group not in self.config.mapping:
                 continue
@@ -139,4 +160,14 @@ class AssignmentDriver(hqmanager.assignment.sql_driver.AssignmentDriver):
                 for perm in self.config.mapping[group]:
                     permissions.append(perm)
 
-        return permissions
+        resolved = (tuple(permissions), PermissionTrie(permissions))
+        self.permission_cache.set(username, resolved)
+        return resolved
+
+    def invalidate_local(self, username=None):
+        super(AssignmentDriver, self).invalidate_local(username)
+
+        if username is None:
+            self.permission_cache.clear()
+        else:
+            self.permission_cache.delete(username)
@@ -0,0 +1,61 @@
+class PermissionNode(object):
+
+    __slots__ = ['children', 'granted']
+
+    def __init__(self):
+        self.children = {}
+        self.granted = False
+
+
+class PermissionTrie(object):
+    """Compiled index of a user's granted permissions keyed on their dotted segments.
+
+    A granted permission matches when it is a prefix of the requested one, segment
+    by segment. A "*" segment matches anything unless exact is set. Lookups only
+    walk as deep as the requested permission instead of over every grant.
+    """
+
+    def __init__(self, permissions=()):
+        self.root = PermissionNode()
+
+        for permission in permissions:
+            self.add(permission)
+
+    def add(self, permission):
+        node = self.root
+
+        for segment in permission.split("."):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = PermissionNode()
+            node = child
+
+        node.granted = True
+
+    def matches(self, permission, exact=False):
+        segments = permission.split(".")
+        depth = len(segments)
+
+        stack = [(self.root, 0)]
+
+        while stack:
+            (node, i) = stack.pop()
+
+            if node.granted:
+                return True
+
+            if i == depth:
+                continue
+
+            segment = segments[i]
+
+            child = node.children.get(segment)
+            if child is not None:
+                stack.append((child, i + 1))
+
+            if exact is False and segment != "*":
+                child = node.children.get("*")
+                if child is not None:
+                    stack.append((child, i + 1))
+
+        return False
@@ -0,0 +1,45 @@
+import base64
+import hashlib
+import hmac
+import json
+
+
+def urlsafe_encode(data):
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def urlsafe_decode(data):
+    data = data.encode('ascii')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+class TokenSigner(object):
+    """Signs token payloads with an HMAC so they can be verified without a database lookup.
+
+    Tokens look like <base64 json payload>.<base64 hmac-sha256 of the payload>.
+    """
+
+    def __init__(self, secret):
+        self.secret = secret.encode('utf-8')
+
+    def signature(self, body):
+        return urlsafe_encode(hmac.new(self.secret, body.encode('ascii'), hashlib.sha256).digest())
+
+    def sign(self, payload):
+        body = urlsafe_encode(json.dumps(payload, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+        return body + "." + self.signature(body)
+
+    def verify(self, token):
+        """Return the payload of a correctly signed token or None."""
+        if token.count(".") != 1:
+            return None
+
+        (body, signature) = token.split(".")
+
+        try:
+            if not hmac.compare_digest(self.signature(body).encode('ascii'), signature.encode('ascii')):
+                return None
+
+            return json.loads(urlsafe_decode(body).decode('utf-8'))
+        except (TypeError, ValueError, UnicodeError):
+            return None
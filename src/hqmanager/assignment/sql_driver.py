@@ -1,35 +1,58 @@
+import os
 import random
 import hashlib
 import base64
+import binascii
 import datetime
 import logging
 import json
+from collections import namedtuple
 
 from schematics.exceptions import ModelValidationError, ModelConversionError
 from schematics.models import Model
 from schematics.types import StringType
 
 from hqlib.sql.models import UserAssignment, Token, Permission
-from hqmanager.assignment.driver import AssignmentAbstractDriver, AssignmentMissingDBConnectionException
+from hqmanager.assignment.driver import AssignmentAbstractDriver, AssignmentMissingDBConnectionException, \
+    TokenAssignment
+from hqmanager.assignment.permission import PermissionTrie
+from hqmanager.assignment.signed_token import TokenSigner
+from hqmanager.cache import TTLCache
 from hqmanager import unix_time_millis
 
+# Per user state needed to check signed tokens. version is the user's current token version.
+UserState = namedtuple('UserState', ['id', 'version', 'permissions'])
+
+
+def token_version(stored):
+    """The version signed tokens carry, a hash so the stored token can't be read back out of a signed one."""
+    if stored is None:
+        return None
+
+    return hashlib.sha256(stored).hexdigest()
+
 
 class AssignmentDriver(AssignmentAbstractDriver):
     def __init__(self):
         super(AssignmentDriver, self).__init__()
         self.logger = logging.getLogger("hq.manager.assignment.sql")
         self.database = None
+        self.signer = None
+        self.user_cache = TTLCache(10000, 60)
 
     def db_connections(self, **kwargs):
         if 'database' not in kwargs:
             raise AssignmentMissingDBConnectionException("Missing sql connection")
 
         self.database = kwargs['database']
+        self.rabbitmq = kwargs.get('rabbitmq')
 
     def validate_config(self, config):
 
         class ConfigValidator(Model):
             admin_username = StringType(required=True)
+            token_format = StringType(default="random", choices=["random", "signed"])
+            token_secret = StringType(default=None)
 
         try:
             self.config = ConfigValidator(config, strict=False)
@@ -43,6 +66,12 @@ class AssignmentDriver(AssignmentAbstractDriver):
             self.logger.error("Could not validate config for assignment SQL driver " + json.dumps(e.message))
             return False
 
+        if self.config.token_format == "signed":
+            if self.config.token_secret is None:
+                self.logger.error("Signed tokens need a token_secret for the assignment SQL driver")
+                return False
+            self.signer = TokenSigner(self.config.token_secret)
+
         if not self.has_assignment(self.config.admin_username):
             self.create_assignment(self.config.admin_username)
 
@@ -53,7 +82,23 @@ class AssignmentDriver(AssignmentAbstractDriver):
             assignment = session.query(UserAssignment).filter(UserAssignment.username == username).first()
             return assignment.id
 
+    def setup_cache(self, size, ttl):
+        super(AssignmentDriver, self).setup_cache(size, ttl)
+        self.user_cache = TTLCache(size, ttl)
+
+    def invalidate_local(self, username=None):
+        super(AssignmentDriver, self).invalidate_local(username)
+
+        if username is None:
+            self.user_cache.clear()
+        else:
+            self.user_cache.delete(username)
+
     def validate_token(self, token):
+        # Once tokens are signed the stored token is only a version, it is never accepted on its own
+        if self.signer is not None:
+            return self.resolve_signed_token(token) is not None
+
         with self.database.session() as session:
             token = session.query(Token).filter(Token.token == token).first()
             if token is None:
@@ -70,42 +115,34 @@ class AssignmentDriver(AssignmentAbstractDriver):
                 filter(Permission.permission == permission).delete()
             session.commit()
 
+        self.invalidate(username)
+
     def has_permission_user(self, username, permission, exact=False):
 
         if username == self.config.admin_username:
             return True
 
         with self.database.session() as session:
-            perms = session.query(Permission).join(UserAssignment, UserAssignment.id == Permission.user_assignment_id). \
+            perms = session.query(Permission.permission).\
+                join(UserAssignment, UserAssignment.id == Permission.user_assignment_id). \
                 filter(UserAssignment.username == username)
 
-            for perm in perms:
-                perm_split = perm.permission.split(".")
-                permission_split = permission.split(".")
+            return PermissionTrie(perm for (perm,) in perms).matches(permission, exact)
 
-                matches = True
+    def permission_granted(self, username, permissions, permission, exact=False):
 
-                if len(permission_split) >= len(perm_split):
-                    for i in range(0, len(perm_split)):
-                        if perm_split[i] == permission_split[i]:
-                            continue
-                        elif perm_split[i] == "*" and exact is False:
-                            continue
-                        else:
-                            matches = False
-                            break
-                else:
-                    matches = False
+        if username == self.config.admin_username:
+            return True
 
-                if matches is False:
-                    continue
+        return super(AssignmentDriver, self).permission_granted(username, permissions, permission, exact)
 
-                return True
+    def has_permission_token(self, token, permission, exact=False):
+        assignment = self.resolve_token(token)
 
-        return False
+        if assignment is None:
+            return False
 
-    def has_permission_token(self, token, permission, exact=False):
-        return self.has_permission_user(self.get_username_from_token(token), permission, exact)
+        return self.permission_granted(assignment.username, assignment.permissions, permission, exact)
 
     def has_assignment(self, username):
         with self.database.session() as session:
@@ -115,13 +152,117 @@ class AssignmentDriver(AssignmentAbstractDriver):
         return True
 
     def get_username_from_token(self, token):
+        if self.signer is not None:
+            payload = self.signer.verify(token)
+
+            if payload is None:
+                return None
+
+            return payload['u']
+
         with self.database.session() as session:
             assignment = session.query(UserAssignment).join(Token, Token.id == UserAssignment.token_id). \
                 filter(Token.token == token).first()
 
+            if assignment is None:
+                return None
+
             return assignment.username
 
+    def resolve_token(self, token):
+        if self.signer is not None:
+            return self.resolve_signed_token(token)
+
+        with self.database.session() as session:
+            rows = session.query(UserAssignment.id, UserAssignment.username, Token.updated_at,
+                                 Permission.permission). \
+                join(Token, Token.id == UserAssignment.token_id). \
+                outerjoin(Permission, Permission.user_assignment_id == UserAssignment.id). \
+                filter(Token.token == token).all()
+
+        if len(rows) == 0:
+            return None
+
+        (assignment_id, username, updated_at, _) = rows[0]
+
+        expire_at = unix_time_millis(updated_at + datetime.timedelta(hours=3))
+        if expire_at < unix_time_millis(datetime.datetime.now()):
+            return None
+
+        permissions = PermissionTrie(row[3] for row in rows if row[3] is not None)
+
+        return TokenAssignment(assignment_id, username, expire_at, permissions)
+
+    # Signed tokens are checked against the cached user state so they don't need the database
+    def resolve_signed_token(self, token):
+        payload = self.signer.verify(token)
+
+        if payload is None:
+            return None
+
+        if payload['e'] < unix_time_millis(datetime.datetime.now()):
+            return None
+
+        user = self.get_user_state(payload['u'])
+
+        # A new version means the token was revoked
+        if user is None or user.id != payload['a'] or user.version != payload['v']:
+            return None
+
+        return TokenAssignment(user.id, payload['u'], payload['e'], user.permissions)
+
+    def get_user_state(self, username):
+        user = self.user_cache.get(username)
+
+        if user is not None:
+            return user
+
+        with self.database.session() as session:
+            rows = session.query(UserAssignment.id, Token.token, Permission.permission). \
+                outerjoin(Token, Token.id == UserAssignment.token_id). \
+                outerjoin(Permission, Permission.user_assignment_id == UserAssignment.id). \
+                filter(UserAssignment.username == username).all()
+
+        if len(rows) == 0:
+            return None
+
+        permissions = PermissionTrie(row[2] for row in rows if row[2] is not None)
+        user = UserState(rows[0][0], token_version(rows[0][1]), permissions)
+
+        self.user_cache.set(username, user)
+        return user
+
+    def get_signed_token(self, username, force=False):
+        changed = False
+
+        with self.database.session() as session:
+            assignment = session.query(UserAssignment).filter(UserAssignment.username == username).first()
+            if assignment.token is None:
+                assignment.token = Token()
+
+            # With signed tokens the stored token is only hashed into the version embedded in them
+            if assignment.token.token is None or force:
+                assignment.token.token = binascii.hexlify(os.urandom(16))
+                session.add(assignment.token)
+                session.commit()
+                changed = True
+
+            payload = {'u': username,
+                       'a': assignment.id,
+                       'e': unix_time_millis(datetime.datetime.now() + datetime.timedelta(hours=3)),
+                       'v': token_version(assignment.token.token)}
+
+        if changed:
+            self.invalidate(username)
+
+        return self.signer.sign(payload), payload['e']
+
     def get_token(self, username, force=False):
+        if self.signer is not None:
+            return self.get_signed_token(username, force)
+
+        changed = False
+
         with self.database.session() as session:
             assignment = session.query(UserAssignment).filter(UserAssignment.username == username).first()
             if assignment.token is None:
@@ -132,11 +273,17 @@ class AssignmentDriver(AssignmentAbstractDriver):
                 token = base64.b64encode(hashlib.sha256(str(random.getrandbits(256))).digest(),
                                          random.choice(['rA', 'aZ', 'gQ', 'hH', 'hG', 'aR', 'DD'])).rstrip('==')
                 assignment.token.token = token
+                changed = True
 
             token = assignment.token
             session.add(token)
             session.commit()
-            return token.token, unix_time_millis(token.updated_at + datetime.timedelta(hours=3))
+            output = (token.token, unix_time_millis(token.updated_at + datetime.timedelta(hours=3)))
+
+        if changed:
+            self.invalidate(username)
+
+        return output
 
     def get_permissions(self, username):
         permissions = []
@@ -145,8 +292,6 @@ class AssignmentDriver(AssignmentAbstractDriver):
 
             for perm in assignment.permissions:
                 permissions.append(perm.permission)
-        assignment.permissions.append(perm)
-        session.commit()
 
         return permissions
 
@@ -155,6 +300,8 @@ class AssignmentDriver(AssignmentAbstractDriver):
             session.query(UserAssignment).filter(UserAssignment.username == username).delete()
             session.commit()
 
+        self.invalidate(username)
+
     def create_assignment(self, username):
         with self.database.session() as session:
             assignment = UserAssignment(username=username)
@@ -166,3 +313,7 @@ class AssignmentDriver(AssignmentAbstractDriver):
         with self.database.session() as session:
             assignment = session.query(UserAssignment).filter(UserAssignment.username == username).first()
             perm = Permission(permission=permission)
+            assignment.permissions.append(perm)
+            session.commit()
+
+        self.invalidate(username)
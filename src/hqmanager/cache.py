@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """A thread safe LRU cache whose entries also expire after ttl seconds.
+
+    A ttl of None keeps entries until they are evicted or deleted.
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                return default
+
+            (value, expire_at) = entry
+
+            if expire_at is not None and expire_at < time.time():
+                return default
+
+            # Re-insert so the entry becomes the most recently used
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        expire_at = None
+        if ttl is not None:
+            expire_at = time.time() + ttl
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expire_at)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def delete_where(self, predicate):
+        with self.lock:
+            for key, (value, expire_at) in list(self.entries.items()):
+                if predicate(key, value):
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
@@ -1,6 +1,6 @@
 import yaml
 from schematics.models import Model
-from schematics.types import StringType, BaseType, IntType
+from schematics.types import StringType, BaseType, IntType, BooleanType
 from schematics.types.compound import DictType, ListType
 
 
@@ -17,6 +17,8 @@ class BaseConfig(Model):
     identity = DictType(BaseType(), required=True)
     assignment = DictType(BaseType(), required=True)
     paths = DictType(BaseType(), required=True)
+    api = DictType(BaseType(), default=None)
+    messaging = DictType(BaseType(), default=None)
 
 
 class RabbitMQConfig(Model):
@@ -42,6 +44,53 @@ class LDAPConfig(Model):
     base_dn = StringType(required=True)
     bind_username = StringType(required=True)
     bind_password = StringType(required=True)
+    pool_size = IntType(default=5, min_value=1)
+    pool_timeout = IntType(default=10, min_value=1)
+
+
+class MessagingConfig(Model):
+    # queue name -> number of messages handled at once
+    concurrency = DictType(IntType(min_value=1), default={})
+    # threads that finish task launches once their worker alive check is done and how long to wait on a worker
+    liveness_checks = IntType(default=16, min_value=1)
+    liveness_timeout = IntType(default=10, min_value=1)
+    # task launch messages prefetched so their alive checks overlap even without extra task_launch concurrency
+    launch_prefetch = IntType(default=16, min_value=1)
+    # seconds a worker heartbeat counts as proof the worker is alive
+    heartbeat_timeout = IntType(default=30, min_value=1)
+    # task status updates written per transaction and how many milliseconds to wait to fill one
+    status_batch_size = IntType(default=1, min_value=1)
+    status_batch_window = IntType(default=50, min_value=0)
+    # worker registrations written per transaction and how many milliseconds to wait to fill one
+    register_batch_size = IntType(default=1, min_value=1)
+    register_batch_window = IntType(default=50, min_value=0)
+    # long lived channels replies and worker messages are published on and whether the broker confirms them
+    publisher_channels = IntType(default=4, min_value=1)
+    publisher_confirms = BooleanType(default=True)
+    # seconds the manager waits on the rpcs it sends
+    rpc_timeout = IntType(default=10, min_value=1)
+    # seconds between full reloads of the in memory worker directory, 0 only loads it at startup
+    worker_directory_reload = IntType(default=300, min_value=0)
+
+
+class TokenCacheConfig(Model):
+    size = IntType(default=10000, min_value=1)
+    ttl = IntType(default=60, min_value=0)
+
+
+class APIConfig(Model):
+    local_auth = BooleanType(default=False)
+    # tasks returned by GET /task when no limit is given and the largest limit allowed
+    page_size = IntType(default=20, min_value=1)
+    max_page_size = IntType(default=100, min_value=1)
+    # finished jobs whose GET /job/{job_id} response is kept in memory
+    job_cache_size = IntType(default=1000, min_value=1)
+    # longest a GET /job/{job_id}/events request waits for new events, in seconds
+    events_timeout = IntType(default=30, min_value=1)
+    # request threads for everything but waiting events requests
+    threads = IntType(default=10, min_value=1)
+    # events requests that can wait at once, each gets a request thread of its own on top of threads
+    events_waiters = IntType(default=16, min_value=0)
 
 
 class PathConfig(Model):
@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from uuid import uuid4
+
+from hqlib.sql.models import Task, JobTarget
+
+
+def task_events(session, statuses):
+    """Build the events for tasks that just changed, statuses maps task id -> new TaskStatus.
+
+    The job of every task is looked up with one query.
+    """
+    if len(statuses) == 0:
+        return []
+
+    rows = session.query(Task.id, JobTarget.job_id).join(JobTarget, Task.job_target_id == JobTarget.id).\
+        filter(Task.id.in_(list(statuses.keys())))
+
+    # Task ids from messages may be strings
+    statuses = dict((str(task_id), status) for (task_id, status) in statuses.items())
+    at = int(time.time() * 1000)
+
+    return [{'job_id': job_id, 'task_id': task_id, 'status': statuses[str(task_id)].value, 'at': at}
+            for (task_id, job_id) in rows]
+
+
+class JobEvents(object):
+    __slots__ = ('events', 'trimmed')
+
+    def __init__(self, size):
+        # (sequence, event) pairs, oldest first
+        self.events = deque(maxlen=size)
+        # The newest sequence dropped to make room, anything at or before it is gone
+        self.trimmed = 0
+
+
+class EventHub(object):
+    """The latest task status changes of recently active jobs that API requests can wait on.
+
+    Every event gets the next sequence number of this hub. Clients get opaque versions
+    made of the hub id and a sequence, pass the last one they saw as since and get
+    the events of their job after it. If events they have not seen were dropped, or
+    the version is not one this hub handed out (another manager, or before a
+    restart), the answer says reset and the client should fetch the job again.
+
+    Events are published to every manager through the task exchange so a client
+    can wait on any of them. At most waiters requests wait at once, since each one
+    holds an API thread.
+    """
+
+    def __init__(self, publishers=None, hub_id=None, jobs=1000, size=1000, waiters=None):
+        self.logger = logging.getLogger("hq.manager.events")
+        self.publishers = publishers
+        self.id = hub_id or str(uuid4())
+        self.max_jobs = jobs
+        self.size = size
+        self.max_waiters = waiters
+        self.waiters = 0
+        self.condition = threading.Condition()
+        self.sequence = 0
+        # job id -> JobEvents, least recently changed first
+        self.jobs = OrderedDict()
+        # The newest sequence of any job dropped from the hub
+        self.evicted = 0
+
+    def broadcast(self, events):
+        """Send events to every manager's hub, including this one."""
+        if len(events) == 0:
+            return
+
+        if self.publishers is None:
+            self.add(events)
+            return
+
+        try:
+            self.publishers.publish("task", "events", {'events': events})
+        except Exception:
+            self.logger.exception("Error broadcasting " + str(len(events)) + " task events")
+
+    def add(self, events):
+        with self.condition:
+            for event in events:
+                self.sequence += 1
+                key = str(event['job_id'])
+
+                job = self.jobs.pop(key, None)
+                if job is None:
+                    job = JobEvents(self.size)
+
+                if len(job.events) == self.size:
+                    job.trimmed = job.events[0][0]
+
+                job.events.append((self.sequence, event))
+                self.jobs[key] = job
+
+                while len(self.jobs) > self.max_jobs:
+                    (_, dropped) = self.jobs.popitem(last=False)
+                    self.evicted = max(self.evicted, dropped.events[-1][0])
+
+            self.condition.notify_all()
+
+    def since(self, job_id, since):
+        """Return (events, reset) for job_id after since, the caller holds the condition."""
+        if since > self.sequence:
+            return [], True
+
+        job = self.jobs.get(str(job_id))
+
+        if job is None:
+            # The job may have been dropped with events the client has not seen
+            return [], since < self.evicted
+
+        if since < job.trimmed:
+            return [], True
+
+        return [event for (sequence, event) in job.events if sequence > since], False
+
+    def version(self, sequence):
+        return self.id + ":" + str(sequence)
+
+    def sequence_of(self, version):
+        """The sequence of a version this hub handed out, None for any other version."""
+        (hub_id, _, sequence) = version.rpartition(":")
+
+        if hub_id != self.id:
+            return None
+
+        try:
+            return int(sequence)
+        except ValueError:
+            return None
+
+    def wait(self, job_id, since, timeout):
+        """Wait up to timeout seconds for events of job_id after the since version.
+
+        Returns (events, reset, version) where version is what to pass as since next time.
+        Raises TooManyWaitersException if the most requests allowed are waiting already.
+        """
+        deadline = time.time() + timeout
+        since = self.sequence_of(since)
+
+        with self.condition:
+            if since is None:
+                return [], True, self.version(self.sequence)
+
+            if self.max_waiters is not None and self.waiters >= self.max_waiters:
+                raise TooManyWaitersException("Already "+str(self.waiters)+" requests waiting on events")
+
+            self.waiters += 1
+
+            try:
+                while True:
+                    (events, reset) = self.since(job_id, since)
+                    remaining = deadline - time.time()
+
+                    if len(events) > 0 or reset or remaining <= 0:
+                        return events, reset, self.version(self.sequence)
+
+                    self.condition.wait(remaining)
+            finally:
+                self.waiters -= 1
+
+    def latest(self):
+        with self.condition:
+            return self.version(self.sequence)
+
+
+class TooManyWaitersException(Exception):
+
+    def __init__(self, message):
+        super(TooManyWaitersException, self).__init__(message)
@@ -0,0 +1,41 @@
+import threading
+import time
+
+
+class HeartbeatRegistry(object):
+    """In memory table of when each worker (target, framework) was last heard from.
+
+    A worker is considered alive if it was seen within the last timeout seconds.
+    """
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.workers = {}
+
+    def beat(self, target, framework, load=None):
+        with self.lock:
+            self.workers[(target, framework)] = (time.time(), load)
+
+    def seen(self, target, framework):
+        """Mark a worker alive now, keeping the load from its last heartbeat."""
+        with self.lock:
+            entry = self.workers.get((target, framework))
+            self.workers[(target, framework)] = (time.time(), None if entry is None else entry[1])
+
+    def get(self, target, framework):
+        """Return (last_seen, load) or None if the worker has never been seen."""
+        with self.lock:
+            return self.workers.get((target, framework))
+
+    def is_alive(self, target, framework):
+        entry = self.get(target, framework)
+
+        if entry is None:
+            return False
+
+        return time.time() - entry[0] < self.timeout
+
+    def remove(self, target, framework):
+        with self.lock:
+            self.workers.pop((target, framework), None)
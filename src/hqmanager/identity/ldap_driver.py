@@ -3,12 +3,14 @@ import logging
 import ldap as ldap_module
 
 from hqmanager.identity.driver import IdentityAbstractDriver, IdentityMissingDBConnectionException
+from hqmanager.ldap_pool import LDAPConnectionPool
 
 
 class IdentityDriver(IdentityAbstractDriver):
     def __init__(self):
         super(IdentityDriver, self).__init__()
         self.ldap = None
+        self.ldap_pool = None
         self.logger = logging.getLogger("hq.manager.identity.ldap")
 
     def db_connections(self, **kwargs):
@@ -20,6 +22,7 @@ class IdentityDriver(IdentityAbstractDriver):
             raise IdentityMissingDBConnectionException("Missing ldap connection is None")
 
         self.ldap = kwargs['ldap']
+        self.ldap_pool = kwargs.get('ldap_pool') or LDAPConnectionPool(self.ldap)
 
     def validate_config(self, config):
 
@@ -45,12 +48,9 @@ class IdentityDriver(IdentityAbstractDriver):
         return True
 
     def user_exists(self, username):
-        connection = self.ldap.connection_as(self.ldap.bind_username, self.ldap.bind_password)
-
         criteria = "(&(samaccountname=" + username + "))"
         attributes = ['displayName']
-        result = connection.search_s(self.ldap.base_dn, ldap_module.SCOPE_SUBTREE, criteria, attributes)[0][0]
-        connection.unbind()
+        result = self.ldap_pool.search_s(self.ldap.base_dn, ldap_module.SCOPE_SUBTREE, criteria, attributes)[0][0]
 
         if result is None:
             return False
@@ -0,0 +1,120 @@
+import logging
+import time
+from contextlib import contextmanager
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import ldap as ldap_module
+
+# Errors that mean the connection itself is unusable and should be replaced
+CONNECTION_ERRORS = (ldap_module.SERVER_DOWN, ldap_module.UNAVAILABLE, ldap_module.CONNECT_ERROR,
+                     ldap_module.TIMEOUT)
+
+
+class LDAPConnectionPool(object):
+    """A bounded, thread safe pool of connections bound as the ldap service account.
+
+    Connections are opened lazily, checked with a whoami when they have been idle for
+    check_interval seconds and replaced when they fail.
+    """
+
+    def __init__(self, ldap, size=5, timeout=10, check_interval=30, connect=None):
+        self.logger = logging.getLogger("hq.manager.ldap.pool")
+        self.ldap = ldap
+        self.timeout = timeout
+        self.check_interval = check_interval
+
+        if connect is None:
+            connect = lambda: ldap.connection_as(ldap.bind_username, ldap.bind_password)
+        self.connect = connect
+
+        # Each slot holds (connection, last_used) or None when it has not been opened yet
+        self.slots = queue.LifoQueue(size)
+        for _ in range(size):
+            self.slots.put(None)
+
+    def acquire(self):
+        try:
+            slot = self.slots.get(timeout=self.timeout)
+        except queue.Empty:
+            raise LDAPPoolTimeoutException("Timed out waiting for an ldap connection")
+
+        if slot is None:
+            return self.open()
+
+        (connection, last_used) = slot
+
+        if time.time() - last_used < self.check_interval:
+            return connection
+
+        try:
+            connection.whoami_s()
+        except ldap_module.LDAPError as e:
+            self.logger.warning("Replacing unhealthy ldap connection " + str(e))
+            self.discard(connection)
+            return self.open()
+
+        return connection
+
+    def release(self, connection):
+        self.slots.put((connection, time.time()))
+
+    def discard(self, connection):
+        try:
+            connection.unbind()
+        except ldap_module.LDAPError:
+            pass
+
+    def open(self):
+        try:
+            return self.connect()
+        except Exception:
+            # Give the slot back so a failed bind doesn't shrink the pool
+            self.slots.put(None)
+            raise
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+
+        try:
+            yield connection
+        except CONNECTION_ERRORS:
+            self.discard(connection)
+            self.slots.put(None)
+            raise
+        except Exception:
+            self.release(connection)
+            raise
+
+        self.release(connection)
+
+    def search_s(self, base, scope, criteria, attributes):
+        """Run a search on a pooled connection, retrying once on a fresh one if the connection died."""
+        try:
+            with self.connection() as connection:
+                return connection.search_s(base, scope, criteria, attributes)
+        except CONNECTION_ERRORS as e:
+            self.logger.warning("Retrying ldap search on a new connection " + str(e))
+
+        with self.connection() as connection:
+            return connection.search_s(base, scope, criteria, attributes)
+
+    def close(self):
+        while True:
+            try:
+                slot = self.slots.get_nowait()
+            except queue.Empty:
+                return
+
+            if slot is not None:
+                self.discard(slot[0])
+
+
+class LDAPPoolTimeoutException(Exception):
+
+    def __init__(self, message):
+        super(LDAPPoolTimeoutException, self).__init__(message)
@@ -1,4 +1,5 @@
 from hqmanager.messaging.framework import RegisterFrameworkSubscriber
-from hqmanager.messaging.worker import WorkerRunTask, WorkerRegister, WorkerReload, WorkerGet
-from hqmanager.messaging.task import TaskStatusSubscriber, TaskLaunchSubscriber
-from hqmanager.messaging.user import Validate
+from hqmanager.messaging.worker import WorkerRunTask, WorkerRegister, WorkerReload, WorkerGet, WorkerLiveness, \
+    WorkerHeartbeat, WorkerChanged
+from hqmanager.messaging.task import TaskStatusSubscriber, TaskLaunchSubscriber, TaskLaunchBatchSubscriber, TaskEvents
+from hqmanager.messaging.user import Validate, InvalidateTokens
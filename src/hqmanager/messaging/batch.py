@@ -0,0 +1,70 @@
+import logging
+import threading
+import time
+
+
+class MessageBatcher(object):
+    """Collects items and hands them to flush from its own thread in batches.
+
+    A batch is flushed once it has size items or window seconds after its first
+    item arrived, whichever comes first.
+    """
+
+    def __init__(self, size, window, flush, name):
+        self.logger = logging.getLogger("hq.manager.batch." + name)
+        self.size = size
+        self.window = window
+        self.flush = flush
+        self.condition = threading.Condition()
+        self.items = []
+        self.first_at = None
+        self.running = True
+
+        self.thread = threading.Thread(target=self.run, name=name + "-batcher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, item):
+        with self.condition:
+            if len(self.items) == 0:
+                self.first_at = time.time()
+            self.items.append(item)
+            self.condition.notify()
+
+    def ready(self):
+        if len(self.items) >= self.size:
+            return True
+
+        return len(self.items) > 0 and time.time() >= self.first_at + self.window
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.ready():
+                    timeout = None
+                    if len(self.items) > 0:
+                        timeout = max(0, self.first_at + self.window - time.time())
+                    self.condition.wait(timeout)
+
+                if len(self.items) == 0:
+                    return
+
+                batch = self.items[:self.size]
+                self.items = self.items[self.size:]
+                self.first_at = time.time() if len(self.items) > 0 else None
+
+            try:
+                self.flush(batch)
+            except Exception:
+                self.logger.exception("Error flushing batch of " + str(len(batch)))
+
+    def stop(self, timeout=10):
+        """Flush whatever is left and stop the batcher thread, waiting up to timeout seconds for it."""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+        self.thread.join(timeout)
+
+        if self.thread.is_alive():
+            self.logger.warning("Batcher did not finish flushing in " + str(timeout) + " seconds")
@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+
+
+class BroadcastSubscriber(object):
+    """Consumes a routing key every manager has to see on a queue of this manager's own.
+
+    The queue is exclusive and auto deleted, so it goes away with the manager's
+    connection instead of collecting messages after a restart. Messages sent while
+    the connection is down are missed, which subscribers have to cope with. One
+    thread consumes the queue, subclasses implement message_deliver and ack on it.
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, rabbitmq, exchange, routing_key, queue_name):
+        self.logger = logging.getLogger("hq.manager.broadcast." + queue_name)
+        self.rabbitmq = rabbitmq
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.queue_name = queue_name
+        self.running = True
+
+        self.thread = threading.Thread(target=self.run, name=queue_name)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                self.consume()
+            except Exception:
+                self.logger.exception("Error consuming " + self.queue_name + ", reconnecting")
+                time.sleep(1)
+
+    def consume(self):
+        connection = self.rabbitmq.syncconnection()
+
+        try:
+            channel = connection.channel()
+            channel.queue_declare(queue=self.queue_name, exclusive=True, auto_delete=True)
+            channel.queue_bind(queue=self.queue_name, exchange=self.exchange, routing_key=self.routing_key)
+            channel.basic_qos(prefetch_count=1)
+
+            try:
+                channel.basic_consume(queue=self.queue_name, on_message_callback=self.message_deliver)
+            except TypeError:
+                # pika before 1.0
+                channel.basic_consume(self.message_deliver, queue=self.queue_name)
+
+            while self.running:
+                connection.process_data_events(time_limit=1)
+        finally:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    @abstractmethod
+    def message_deliver(self, channel, basic_deliver, properties, body):
+        pass
+
+    def stop(self):
+        self.running = False
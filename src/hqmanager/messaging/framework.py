@@ -1,22 +1,18 @@
-from hqlib.rabbitmq.routing import Subscriber as RoutingSubscriber
-from hqlib.rabbitmq.rpc import RPCReplyPublisher
+from hqmanager.messaging.pool import PooledSubscriber
 import json
 from uuid import uuid4
 
 
-class RegisterFrameworkSubscriber(RoutingSubscriber):
+class RegisterFrameworkSubscriber(PooledSubscriber):
 
-    def __init__(self, rabbitmq):
+    def __init__(self, rabbitmq, concurrency=1, publishers=None):
         super(RegisterFrameworkSubscriber, self).__init__(rabbitmq, "framework", "register",
-                                                          queue_name="framework_register", qos=1)
+                                                          queue_name="framework_register", concurrency=concurrency,
+                                                          publishers=publishers)
 
-    def message_deliver(self, channel, basic_deliver, properties, body):
+    def handle_message(self, channel, basic_deliver, properties, body):
         data = json.loads(body)
 
         uuid = uuid4()
 
-        publisher = RPCReplyPublisher(self.rabbitmq, properties.reply_to, properties.correlation_id)
-        publisher.publish({"id": str(uuid)})
-        publisher.close()
-
-        channel.basic_ack(basic_deliver.delivery_tag)
+        self.reply(channel, basic_deliver, properties, {"id": str(uuid)})
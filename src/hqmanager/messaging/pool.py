@@ -0,0 +1,170 @@
+import logging
+import threading
+from abc import ABCMeta, abstractmethod
+from collections import deque
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from hqlib.rabbitmq.routing import Subscriber as RoutingSubscriber
+from hqmanager.messaging.publisher import PublisherPool
+
+
+class WorkerPool(object):
+    """A fixed number of threads running submitted work.
+
+    Work submitted with a key runs in submission order with other work for the
+    same key, work for different keys (or without one) runs concurrently.
+    """
+
+    def __init__(self, size, name):
+        self.logger = logging.getLogger("hq.manager.pool." + name)
+        self.work = queue.Queue()
+        self.lock = threading.Lock()
+        # key -> work waiting for the currently running work with that key
+        self.pending = {}
+        self.threads = []
+
+        for i in range(size):
+            thread = threading.Thread(target=self.run, name=name + "-" + str(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, work, key=None):
+        if key is not None:
+            with self.lock:
+                if key in self.pending:
+                    self.pending[key].append(work)
+                    return
+                self.pending[key] = deque()
+
+        self.work.put((work, key))
+
+    def run(self):
+        while True:
+            item = self.work.get()
+
+            if item is None:
+                return
+
+            (work, key) = item
+
+            try:
+                work()
+            except Exception:
+                self.logger.exception("Error running pooled work")
+
+            if key is not None:
+                self.next(key)
+
+    def next(self, key):
+        with self.lock:
+            waiting = self.pending[key]
+
+            if len(waiting) == 0:
+                del self.pending[key]
+                return
+
+            work = waiting.popleft()
+
+        self.work.put((work, key))
+
+    def stop(self):
+        for _ in self.threads:
+            self.work.put(None)
+
+
+class ThreadSafeChannel(object):
+    """Wraps a channel so acks from pool threads are sent on the connection's own thread.
+
+    settled is set once the message was acked, nacked or rejected through the wrapper.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.settled = False
+
+    def call(self, callback):
+        connection = self.channel.connection
+
+        if hasattr(connection, 'add_callback_threadsafe'):
+            connection.add_callback_threadsafe(callback)
+        else:
+            connection.ioloop.add_callback_threadsafe(callback)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.settled = True
+        self.call(lambda: self.channel.basic_ack(delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.settled = True
+        self.call(lambda: self.channel.basic_nack(delivery_tag, multiple, requeue))
+
+    def basic_reject(self, delivery_tag=0, requeue=True):
+        self.settled = True
+        self.call(lambda: self.channel.basic_reject(delivery_tag, requeue))
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+
+class PooledSubscriber(RoutingSubscriber):
+    """A routing subscriber that can handle up to concurrency messages at once.
+
+    The queue prefetches concurrency (or prefetch) messages and hands them to a WorkerPool.
+    Subclasses implement handle_message and can return a key from message_key
+    to keep messages with the same key in order. Replies and other publishes go
+    through the shared publishers pool.
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, rabbitmq, exchange, routing_key, queue_name=None, concurrency=1, prefetch=None,
+                 publishers=None):
+        super(PooledSubscriber, self).__init__(rabbitmq, exchange, routing_key, queue_name=queue_name,
+                                               qos=prefetch or concurrency)
+        self.publishers = publishers or PublisherPool(rabbitmq, 1)
+        self.pool = None
+
+        if concurrency > 1:
+            self.pool = WorkerPool(concurrency, queue_name or routing_key)
+
+    def message_deliver(self, channel, basic_deliver, properties, body):
+        if self.pool is None:
+            self.handle_message(channel, basic_deliver, properties, body)
+            return
+
+        channel = ThreadSafeChannel(channel)
+
+        def work():
+            try:
+                self.handle_message(channel, basic_deliver, properties, body)
+            except Exception:
+                # Don't let a failed message hold on to one of the prefetched slots, rejecting
+                # a message that was already acked would close the channel
+                if not channel.settled:
+                    channel.basic_reject(basic_deliver.delivery_tag, requeue=False)
+                raise
+
+        self.pool.submit(work, self.message_key(properties, body))
+
+    def message_key(self, properties, body):
+        return None
+
+    def reply(self, channel, basic_deliver, properties, data):
+        """Answer the rpc that sent this message and ack it."""
+        self.publishers.reply(properties.reply_to, properties.correlation_id, data)
+        channel.basic_ack(basic_deliver.delivery_tag)
+
+    @abstractmethod
+    def handle_message(self, channel, basic_deliver, properties, body):
+        pass
+
+    def stop(self):
+        super(PooledSubscriber, self).stop()
+
+        if self.pool is not None:
+            self.pool.stop()
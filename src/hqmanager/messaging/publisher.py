@@ -0,0 +1,110 @@
+import json
+import logging
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import pika
+from pika.exceptions import AMQPError
+
+
+def reply_message(reply_to, correlation_id, data):
+    """The (exchange, routing_key, data, properties) that answers an rpc."""
+    return "", reply_to, data, pika.BasicProperties(correlation_id=correlation_id)
+
+
+class PublisherPool(object):
+    """A thread safe pool of long lived publishing channels.
+
+    Each channel has its own blocking connection and is used by one thread at a
+    time. With confirm set channels are in confirm mode so a publish returns once
+    the broker has the message. Broken channels are replaced and the publish is
+    retried once.
+    """
+
+    def __init__(self, rabbitmq, size=4, confirm=True, timeout=10):
+        self.logger = logging.getLogger("hq.manager.publisher")
+        self.rabbitmq = rabbitmq
+        self.confirm = confirm
+        self.timeout = timeout
+
+        # Each slot holds (connection, channel) or None when it has not been opened yet
+        self.slots = queue.LifoQueue(size)
+        for _ in range(size):
+            self.slots.put(None)
+
+    def open(self):
+        connection = self.rabbitmq.syncconnection()
+        channel = connection.channel()
+
+        if self.confirm:
+            channel.confirm_delivery()
+
+        return connection, channel
+
+    def discard(self, slot):
+        try:
+            slot[0].close()
+        except Exception:
+            pass
+
+    def send(self, messages, progress):
+        try:
+            slot = self.slots.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PublisherPoolTimeoutException("Timed out waiting for a publishing channel")
+
+        try:
+            if slot is None:
+                slot = self.open()
+
+            for (exchange, routing_key, data, properties) in messages:
+                slot[1].basic_publish(exchange=exchange, routing_key=routing_key, body=json.dumps(data),
+                                      properties=properties)
+                progress[0] += 1
+        except Exception:
+            if slot is not None:
+                self.discard(slot)
+            self.slots.put(None)
+            raise
+
+        self.slots.put(slot)
+
+    def publish_batch(self, messages):
+        """Publish a list of (exchange, routing_key, data, properties) on one channel."""
+        if len(messages) == 0:
+            return
+
+        progress = [0]
+
+        try:
+            self.send(messages, progress)
+        except AMQPError as e:
+            # Only resend what didn't make it out before the channel broke
+            self.logger.warning("Retrying publish on a new channel " + str(e))
+            self.send(messages[progress[0]:], [0])
+
+    def publish(self, exchange, routing_key, data, properties=None):
+        self.publish_batch([(exchange, routing_key, data, properties)])
+
+    def reply(self, reply_to, correlation_id, data):
+        """Answer an rpc."""
+        self.publish(*reply_message(reply_to, correlation_id, data))
+
+    def close(self):
+        while True:
+            try:
+                slot = self.slots.get_nowait()
+            except queue.Empty:
+                return
+
+            if slot is not None:
+                self.discard(slot)
+
+
+class PublisherPoolTimeoutException(Exception):
+
+    def __init__(self, message):
+        super(PublisherPoolTimeoutException, self).__init__(message)
@@ -0,0 +1,201 @@
+import json
+import logging
+import threading
+import time
+from uuid import uuid4
+
+import pika
+
+
+class RPCCall(object):
+    """An rpc waiting on its reply.
+
+    The call is resolved exactly once, with the reply data or with None if no reply
+    came before the deadline.
+    """
+
+    def __init__(self, correlation_id, deadline, callback=None):
+        self.correlation_id = correlation_id
+        self.deadline = deadline
+        self.callback = callback
+        self.data = None
+        self.event = threading.Event()
+
+    def resolve(self, data):
+        self.data = data
+        self.event.set()
+
+        if self.callback is not None:
+            self.callback(data)
+
+    def wait(self):
+        """Block until the reply arrives or the deadline passes and return the reply data or None."""
+        self.event.wait(max(0, self.deadline - time.time()))
+        return self.data
+
+
+class RPCClient(object):
+    """Sends rpcs and collects their replies over one long lived reply queue.
+
+    One thread consumes an exclusive reply queue and hands each reply to the call
+    with the same correlation id. Requests are published through the shared
+    publishers pool, so any number of threads can have rpcs in flight without
+    declaring a queue per call. Calls past their deadline are resolved with None
+    by a second thread, which keeps running while the connection is down, and
+    replies that arrive after that are dropped.
+    """
+
+    def __init__(self, rabbitmq, publishers, timeout=10):
+        self.logger = logging.getLogger("hq.manager.rpc")
+        self.rabbitmq = rabbitmq
+        self.publishers = publishers
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # correlation id -> RPCCall
+        self.calls = {}
+        self.reply_to = None
+        self.ready = threading.Event()
+        self.running = True
+
+        self.thread = threading.Thread(target=self.run, name="rpc-client")
+        self.thread.daemon = True
+        self.expire_thread = threading.Thread(target=self.run_expire, name="rpc-expire")
+        self.expire_thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        self.expire_thread.start()
+        self.ready.wait(self.timeout)
+
+    def run(self):
+        while self.running:
+            try:
+                self.consume()
+            except Exception:
+                self.logger.exception("Error consuming rpc replies, reconnecting")
+                time.sleep(1)
+
+    def run_expire(self):
+        while self.running:
+            time.sleep(1)
+
+            try:
+                self.expire()
+            except Exception:
+                self.logger.exception("Error expiring rpc calls")
+
+    def consume(self):
+        connection = self.rabbitmq.syncconnection()
+
+        try:
+            channel = connection.channel()
+            result = channel.queue_declare(queue='', exclusive=True, auto_delete=True)
+            reply_to = result.method.queue
+
+            try:
+                channel.basic_consume(queue=reply_to, on_message_callback=self.on_reply, auto_ack=True)
+            except TypeError:
+                # pika before 1.0
+                channel.basic_consume(self.on_reply, queue=reply_to, no_ack=True)
+
+            with self.lock:
+                self.reply_to = reply_to
+            self.ready.set()
+
+            while self.running:
+                connection.process_data_events(time_limit=1)
+        finally:
+            # Replies to the old queue are lost, calls still waiting on them will expire
+            self.ready.clear()
+
+            with self.lock:
+                self.reply_to = None
+
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def on_reply(self, channel, basic_deliver, properties, body):
+        with self.lock:
+            call = self.calls.pop(properties.correlation_id, None)
+
+        if call is None:
+            self.logger.debug("Dropping late rpc reply " + str(properties.correlation_id))
+            return
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self.logger.warning("Invalid rpc reply " + str(properties.correlation_id))
+            data = None
+
+        call.resolve(data)
+
+    def expire(self):
+        now = time.time()
+
+        with self.lock:
+            expired = [call for call in self.calls.values() if call.deadline <= now]
+
+            for call in expired:
+                del self.calls[call.correlation_id]
+
+        for call in expired:
+            call.resolve(None)
+
+    def send(self, exchange, routing_key, data, callback=None, timeout=None):
+        """Publish an rpc and return its RPCCall.
+
+        callback(data) is run on the reply or expiry thread when the call resolves so it must not block.
+        """
+        timeout = timeout or self.timeout
+        call = RPCCall(str(uuid4()), time.time() + timeout, callback)
+
+        if not self.ready.wait(timeout):
+            self.logger.warning("No rpc reply queue to send " + exchange + "." + routing_key)
+            call.resolve(None)
+            return call
+
+        # The reply queue can be lost between the wait and here
+        with self.lock:
+            reply_to = self.reply_to
+
+            if reply_to is not None:
+                self.calls[call.correlation_id] = call
+
+        if reply_to is None:
+            self.logger.warning("Lost the rpc reply queue before sending " + exchange + "." + routing_key)
+            call.resolve(None)
+            return call
+
+        # Requests nobody is waiting on any more expire in the queue
+        properties = pika.BasicProperties(reply_to=reply_to, correlation_id=call.correlation_id,
+                                          expiration=str(int(timeout * 1000)))
+
+        try:
+            self.publishers.publish(exchange, routing_key, data, properties)
+        except Exception:
+            self.logger.exception("Error publishing rpc " + exchange + "." + routing_key)
+
+            with self.lock:
+                pending = self.calls.pop(call.correlation_id, None)
+
+            if pending is not None:
+                pending.resolve(None)
+
+        return call
+
+    def call(self, exchange, routing_key, data, timeout=None):
+        """Send an rpc and block until its reply data, or None if it failed or timed out."""
+        return self.send(exchange, routing_key, data, timeout=timeout).wait()
+
+    def stop(self):
+        self.running = False
+
+        with self.lock:
+            calls = list(self.calls.values())
+            self.calls = {}
+
+        for call in calls:
+            call.resolve(None)
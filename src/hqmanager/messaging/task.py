@@ -1,126 +1,468 @@
-from hqlib.rabbitmq.routing import Subscriber as RoutingSubscriber
-from hqlib.rabbitmq.rpc import RPCReplyPublisher, RPCPublisher
-from hqmanager.messaging.worker import WorkerRunTask
+from hqmanager.messaging.pool import PooledSubscriber, ThreadSafeChannel
+from hqmanager.messaging.batch import MessageBatcher
+from hqmanager.messaging.broadcast import BroadcastSubscriber
 import json
 import datetime
+import threading
+from sqlalchemy.orm import subqueryload
 from hqlib.sql.models import TaskStatus, Task, Worker
+from hqmanager.events import task_events
+from hqmanager.task_state import can_transition, transition, transition_many, read_tasks, move
+from hqmanager.progress import record_progress
 
 
-class TaskLaunchSubscriber(RoutingSubscriber):
+def task_payload(task):
+    """The run message a worker gets for a task."""
+    data = {'id': task.id, 'name': task.name, 'actions': []}
 
-    def __init__(self, rabbitmq, database):
-        super(TaskLaunchSubscriber, self).__init__(rabbitmq, "task", "launch", queue_name="task_launch", qos=1)
+    for action in task.actions:
+        action_data = {'processor': action.processor, 'arguments': {}}
+
+        if action.arguments is not None:
+            action_data['arguments'] = action.arguments
+
+        data['actions'].append(action_data)
+
+    return data
+
+
+def run_message(launch):
+    """The (exchange, routing_key, data, properties) that runs a launch on its worker."""
+    return "worker-"+launch['target'], "run-"+launch['framework'], launch['task'], None
+
+
+def broadcast_events(hub, session, statuses):
+    """Tell every manager's event hub about tasks that changed status, statuses maps task id -> TaskStatus."""
+    if hub is None or len(statuses) == 0:
+        return
+
+    # The status change is committed already, losing its event must not fail the message
+    try:
+        hub.broadcast(task_events(session, statuses))
+    except Exception:
+        hub.logger.exception("Error building events for "+str(len(statuses))+" tasks")
+
+
+def status_update(data):
+    """Work out the status and column values a task status message sets, None if the status is unknown."""
+    if data['status'] == TaskStatus.RUNNING.value:
+        return TaskStatus.RUNNING, {}
+
+    elif data['status'] == TaskStatus.FINISHED.value:
+        return TaskStatus.FINISHED, {'stopped_at': datetime.datetime.now()}
+
+    elif data['status'] == TaskStatus.FAILED.value:
+        return TaskStatus.FAILED, {'error_message': data.get('message'), 'stopped_at': datetime.datetime.now()}
+
+    return None
+
+
+def task_key(body):
+    """The task id a message is about, None if it is malformed so handle_message can drop it."""
+    try:
+        key = json.loads(body)['task_id']
+        hash(key)
+        return key
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def parse_status(body):
+    """Return (data, update) for a task status message, None if it is malformed or the status is unknown."""
+    try:
+        data = json.loads(body)
+        update = status_update(data)
+        data['task_id']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+    if update is None:
+        return None
+
+    return data, update
+
+
+class TaskLaunchSubscriber(PooledSubscriber):
+    """Launches tasks on workers in stages.
+
+    The task and worker are validated in a short session, the worker liveness check
+    runs asynchronously so many launches can wait on workers at once, then the task
+    is moved to STARTING in a single update and sent to the worker.
+    """
+
+    def __init__(self, rabbitmq, database, liveness, concurrency=1, publishers=None, events=None, prefetch=1):
+        # The ack waits on the liveness check so the prefetch is what lets launches overlap
+        super(TaskLaunchSubscriber, self).__init__(rabbitmq, "task", "launch", queue_name="task_launch",
+                                                   concurrency=concurrency, prefetch=max(prefetch, concurrency),
+                                                   publishers=publishers)
         self.database = database
+        self.liveness = liveness
+        self.events = events
 
-    def message_deliver(self, channel, basic_deliver, properties, body):
+    # Keep messages for the same task in order
+    def message_key(self, properties, body):
+        return task_key(body)
+
+    def handle_message(self, channel, basic_deliver, properties, body):
         data = json.loads(body)
 
         self.logger.info("Received task launch "+str(data['task_id']))
 
+        launch = self.validate_launch(data)
+
+        if 'error' in launch:
+            self.reply(channel, basic_deliver, properties, launch)
+            return
+
+        # The rest of the launch happens on other threads
+        if not isinstance(channel, ThreadSafeChannel):
+            channel = ThreadSafeChannel(channel)
+
+        def alive(error):
+            if error is not None:
+                self.reply(channel, basic_deliver, properties, {"error": error, "code": 400})
+                return
+
+            try:
+                output = self.start_launch(launch)
+            except Exception:
+                self.logger.exception("Error starting task "+str(launch['task']['id']))
+                output = {"error": "Error starting task", "code": 500}
+
+            self.reply(channel, basic_deliver, properties, output)
+
+        self.liveness.check(launch['target'], launch['framework'], alive)
+
+    def validate_launch(self, data):
         with self.database.session() as session:
             task = session.query(Task).filter(Task.id == data['task_id']).first()
 
-            publisher = RPCReplyPublisher(self.rabbitmq, properties.reply_to, properties.correlation_id)
-
             if task is None:
-                publisher.publish({"error": "Unknown task_id "+data['task_id'], "code": 404})
-                publisher.close()
-                channel.basic_ack(basic_deliver.delivery_tag)
-                return
+                return {"error": "Unknown task_id "+str(data['task_id']), "code": 404}
 
-            if task.status != TaskStatus.PENDING and task.status != TaskStatus.LOST:
+            if not can_transition(task.status, TaskStatus.STARTING):
                 self.logger.warning("Task cannot launch")
-                publisher.publish({"error": "Task "+data['task_id']+" does not have PENDING or LOST status", "code": 400})
-                publisher.close()
-                channel.basic_ack(basic_deliver.delivery_tag)
-                return
+                return {"error": "Task "+str(data['task_id'])+" does not have PENDING or LOST status", "code": 400}
 
             worker = session.query(Worker).filter(Worker.id == data['worker_id']).first()
 
             if worker is None:
-                publisher.publish({"error": "Invalid worker id supplied", "code": 400})
-                publisher.close()
-                channel.basic_ack(basic_deliver.delivery_tag)
-                return
+                return {"error": "Invalid worker id supplied", "code": 400}
 
-            publisher_worker = RPCPublisher(self.rabbitmq, "worker-"+worker.target, "alive-"+worker.framework)
-            corr_id = publisher_worker.publish({})
+            return {'task': task_payload(task), 'target': worker.target, 'framework': worker.framework}
 
-            if corr_id is None:
-                publisher.publish({"error": "Worker Alive RPC corr_id is None", "code": 400})
-                publisher.close()
-                channel.basic_ack(basic_deliver.delivery_tag)
-                return
+    def start_launch(self, launch):
+        task_id = launch['task']['id']
 
-            if publisher_worker.get_data(corr_id) is None:
-                publisher.publish({"error": "Worker did not reply it is dead", "code": 400})
-                publisher.close()
-                channel.basic_ack(basic_deliver.delivery_tag)
-                return
+        # Only start the task if nothing else moved it out of PENDING or LOST while we waited on the worker
+        with self.database.session() as session:
+            started = transition(session, task_id, TaskStatus.STARTING)
+            session.commit()
+
+            if started:
+                broadcast_events(self.events, session, {task_id: TaskStatus.STARTING})
+
+        if not started:
+            return {"error": "Task "+str(task_id)+" does not have PENDING or LOST status", "code": 400}
+
+        self.publishers.publish(*run_message(launch))
+
+        return {"status": TaskStatus.STARTING.value, "code": 200}
+
+
+class TaskLaunchBatchSubscriber(PooledSubscriber):
+    """Launches every task of a batch of (task_id, worker_id) pairs with one reply.
+
+    All tasks and workers are validated with one query each, every distinct worker is
+    checked once, and the tasks on live workers move to STARTING in one update.
+    """
+
+    def __init__(self, rabbitmq, database, liveness, concurrency=1, publishers=None, events=None, prefetch=1):
+        super(TaskLaunchBatchSubscriber, self).__init__(rabbitmq, "task", "launch_batch",
+                                                        queue_name="task_launch_batch", concurrency=concurrency,
+                                                        prefetch=max(prefetch, concurrency), publishers=publishers)
+        self.database = database
+        self.liveness = liveness
+        self.events = events
+
+    def handle_message(self, channel, basic_deliver, properties, body):
+        data = json.loads(body)
+
+        self.logger.info("Received task launch batch of "+str(len(data['tasks'])))
+
+        (results, launches) = self.validate_launches(data['tasks'])
+
+        if not isinstance(channel, ThreadSafeChannel):
+            channel = ThreadSafeChannel(channel)
+
+        # One liveness check per distinct worker
+        workers = {}
+        for launch in launches:
+            workers.setdefault((launch['target'], launch['framework']), []).append(launch)
+
+        lock = threading.Lock()
+        remaining = [len(workers)]
+        dead = {}
+
+        def finish():
+            try:
+                alive = [launch for key, worker_launches in workers.items() if key not in dead
+                         for launch in worker_launches]
+                results.extend(self.start_launches(alive))
+            except Exception:
+                self.logger.exception("Error starting task launch batch")
+                results.extend({"task_id": launch['task']['id'], "error": "Error starting task", "code": 500}
+                               for launch in launches if (launch['target'], launch['framework']) not in dead)
+
+            for key, error in dead.items():
+                results.extend({"task_id": launch['task']['id'], "error": error, "code": 400}
+                               for launch in workers[key])
+
+            self.reply(channel, basic_deliver, properties, {"tasks": results, "code": 200})
 
-            task.status = TaskStatus.STARTING
-            session.add(task)
+        def checked(key):
+            def alive(error):
+                with lock:
+                    if error is not None:
+                        dead[key] = error
+                    remaining[0] -= 1
+                    done = remaining[0] == 0
+
+                if done:
+                    finish()
+            return alive
+
+        if len(workers) == 0:
+            finish()
+            return
+
+        for (target, framework) in list(workers.keys()):
+            self.liveness.check(target, framework, checked((target, framework)))
+
+    def validate_launches(self, items):
+        results = []
+        launches = []
+
+        task_ids = [item['task_id'] for item in items]
+        worker_ids = [item['worker_id'] for item in items]
+
+        with self.database.session() as session:
+            tasks = session.query(Task).options(subqueryload(Task.actions)).filter(Task.id.in_(task_ids))
+            tasks = dict((str(task.id), task) for task in tasks)
+
+            workers = session.query(Worker).filter(Worker.id.in_(worker_ids))
+            workers = dict((str(worker.id), worker) for worker in workers)
+
+            seen = set()
+
+            for item in items:
+                task = tasks.get(str(item['task_id']))
+                worker = workers.get(str(item['worker_id']))
+
+                # Only the first launch of a task is run so it is not dispatched twice
+                if str(item['task_id']) in seen:
+                    results.append({"task_id": item['task_id'], "code": 400,
+                                    "error": "Task "+str(item['task_id'])+" is in the batch more than once"})
+                    continue
+
+                seen.add(str(item['task_id']))
+
+                if task is None:
+                    results.append({"task_id": item['task_id'], "error": "Unknown task_id "+str(item['task_id']),
+                                    "code": 404})
+                elif not can_transition(task.status, TaskStatus.STARTING):
+                    results.append({"task_id": item['task_id'], "code": 400,
+                                    "error": "Task "+str(item['task_id'])+" does not have PENDING or LOST status"})
+                elif worker is None:
+                    results.append({"task_id": item['task_id'], "error": "Invalid worker id supplied", "code": 400})
+                else:
+                    launches.append({'task': task_payload(task), 'target': worker.target,
+                                     'framework': worker.framework})
+
+        return results, launches
+
+    def start_launches(self, launches):
+        if len(launches) == 0:
+            return []
+
+        task_ids = [launch['task']['id'] for launch in launches]
+
+        with self.database.session() as session:
+            startable = transition_many(session, task_ids, TaskStatus.STARTING)
             session.commit()
-            session.refresh(task)
 
-            data = {'id': task.id, 'name': task.name, 'actions': []}
+            broadcast_events(self.events, session, dict((task_id, TaskStatus.STARTING) for task_id in startable))
 
-            for action in task.actions:
-                action_data = {'processor': action.processor, 'arguments': {}}
+        results = []
+        messages = []
 
-                if action.arguments is not None:
-                    action_data['arguments'] = action.arguments
+        for launch in launches:
+            task_id = launch['task']['id']
 
-                data['actions'].append(action_data)
+            if task_id not in startable:
+                results.append({"task_id": task_id, "code": 400,
+                                "error": "Task "+str(task_id)+" does not have PENDING or LOST status"})
+                continue
 
-            WorkerRunTask(self.rabbitmq, worker).run(data)
+            messages.append(run_message(launch))
+            results.append({"task_id": task_id, "status": TaskStatus.STARTING.value, "code": 200})
+
+        # Every run message goes out on one channel checkout
+        self.publishers.publish_batch(messages)
+
+        return results
 
-            publisher.publish({"status": task.status.value, "code": 200})
-            publisher.close()
-            channel.basic_ack(basic_deliver.delivery_tag)
 
+class TaskStatusSubscriber(PooledSubscriber):
+    """Applies task status updates from workers.
 
-class TaskStatusSubscriber(RoutingSubscriber):
+    With a batch_size above 1 updates are coalesced: they are buffered for up to
+    batch_window seconds or batch_size messages, applied to the tasks in memory and
+    written with bulk updates in one transaction. Messages are acked once it commits.
+    """
 
-    def __init__(self, rabbitmq, database):
-        super(TaskStatusSubscriber, self).__init__(rabbitmq, "task", "task_status", queue_name="task_status", qos=1)
+    def __init__(self, rabbitmq, database, concurrency=1, batch_size=1, batch_window=0.05, publishers=None,
+                 events=None):
+        prefetch = None
+        if batch_size > 1:
+            # Acks for a batch are sent in delivery order so it has to be consumed on one thread
+            concurrency = 1
+            prefetch = batch_size * 2
+
+        super(TaskStatusSubscriber, self).__init__(rabbitmq, "task", "task_status", queue_name="task_status",
+                                                   concurrency=concurrency, prefetch=prefetch,
+                                                   publishers=publishers)
         self.database = database
+        self.events = events
+        self.batcher = None
+
+        if batch_size > 1:
+            self.batcher = MessageBatcher(batch_size, batch_window, self.flush_statuses, "task_status")
 
     def message_deliver(self, channel, basic_deliver, properties, body):
-        data = json.loads(body)
+        if self.batcher is None:
+            super(TaskStatusSubscriber, self).message_deliver(channel, basic_deliver, properties, body)
+            return
+
+        status = parse_status(body)
+
+        # Bad messages are dropped here so they never fail, and requeue, a whole batch
+        if status is None:
+            self.logger.warning("Dropping invalid task status message "+repr(body[:200]))
+            channel.basic_ack(basic_deliver.delivery_tag)
+            return
+
+        (data, update) = status
+        self.batcher.add((ThreadSafeChannel(channel), basic_deliver, data, update))
+
+    def flush_statuses(self, batch):
+        (channel, last_deliver, _, _) = batch[-1]
+
+        try:
+            with self.database.session() as session:
+                task_ids = set(data['task_id'] for (_, _, data, _) in batch)
+                rows = read_tasks(session, task_ids)
+
+                statuses = dict((str(task_id), (task_id, status)) for (task_id, (status, _)) in rows.items())
+                changes = {}
+                # The updates coalesced into each change, in order, to apply one by one if the task moved meanwhile
+                updates = {}
+
+                for (_, _, data, update) in batch:
+                    key = str(data['task_id'])
+
+                    if key not in statuses:
+                        self.logger.warning("Unknown task in TaskStatusSubscriber")
+                        continue
+
+                    (task_id, status) = statuses[key]
+
+                    if not can_transition(status, update[0]):
+                        self.logger.warning("Task "+key+" status cannot be set to "+data['status'] +
+                                            " from "+status.value)
+                        continue
+
+                    statuses[key] = (task_id, update[0])
+                    changes.setdefault(key, {'id': task_id}).update(update[1])
+                    changes[key]['status'] = update[0]
+                    updates.setdefault(key, []).append(update)
+
+                progress = []
+                events = {}
+
+                # Each task is written only if it still has the status it was read with
+                for (key, change) in sorted(changes.items(), key=lambda item: item[1]['id']):
+                    task_id = change['id']
+                    (old, job_id) = rows[task_id]
+                    values = dict((column, value) for (column, value) in change.items()
+                                  if column not in ('id', 'status'))
+
+                    if len(move(session, [task_id], old, change['status'], values)) > 0:
+                        progress.append((job_id, old, change['status']))
+                        events[task_id] = change['status']
+                        continue
+
+                    for (status, values) in updates[key]:
+                        if transition(session, task_id, status, **values):
+                            events[task_id] = status
+
+                record_progress(session, progress)
+                session.commit()
+
+                broadcast_events(self.events, session, events)
+        except Exception:
+            self.logger.exception("Error flushing task statuses, requeueing "+str(len(batch)))
+            channel.basic_nack(last_deliver.delivery_tag, multiple=True, requeue=True)
+            return
+
+        channel.basic_ack(last_deliver.delivery_tag, multiple=True)
+
+    def stop(self):
+        super(TaskStatusSubscriber, self).stop()
+
+        if self.batcher is not None:
+            self.batcher.stop()
+
+    # Keep messages for the same task in order
+    def message_key(self, properties, body):
+        return task_key(body)
+
+    def handle_message(self, channel, basic_deliver, properties, body):
+        status = parse_status(body)
+
+        if status is None:
+            self.logger.warning("Dropping invalid task status message "+repr(body[:200]))
+            channel.basic_ack(basic_deliver.delivery_tag)
+            return
+
+        (data, update) = status
 
         self.logger.info("Received task status "+str(data['task_id'])+" "+data['status'])
 
         with self.database.session() as session:
-            task = session.query(Task).filter(Task.id == data['task_id']).first()
+            changed = transition(session, data['task_id'], update[0], **update[1])
+            session.commit()
 
-            if task is None:
-                self.logger.warning("Unknown task in TaskStatusSubscriber")
-                channel.basic_ack(basic_deliver.delivery_tag)
-                return
+            if changed:
+                broadcast_events(self.events, session, {data['task_id']: update[0]})
 
-            if data['status'] == TaskStatus.RUNNING.value:
-                if task.status != TaskStatus.STARTING and task.status != TaskStatus.RUNNING:
-                    self.logger.warning("Task status cannot be set to running. Not in starting or running status ("+task.status.value+")")
-                else:
-                    task.status = TaskStatus.RUNNING
-                    session.add(task)
-                    session.commit()
+        if not changed:
+            self.logger.warning("Task "+str(data['task_id'])+" is unknown or its status cannot be set to " +
+                                data['status'])
 
-            elif data['status'] == TaskStatus.FINISHED.value:
-                if task.status != TaskStatus.RUNNING:
-                    self.logger.warning("Task status cannot be set to finished. Not in running status ("+task.status.value+")")
-                else:
-                    task.status = TaskStatus.FINISHED
-                    task.stopped_at = datetime.datetime.now()
-                    session.add(task)
-                    session.commit()
-
-            elif data['status'] == TaskStatus.FAILED.value:
-                task.status = TaskStatus.FAILED
-                task.error_message = data['message']
-                task.stopped_at = datetime.datetime.now()
-                session.add(task)
-                session.commit()
+        channel.basic_ack(basic_deliver.delivery_tag)
+
+
+class TaskEvents(BroadcastSubscriber):
+
+    def __init__(self, rabbitmq, events, manager_id):
+        # Every manager binds its own queue so each one sees every event
+        super(TaskEvents, self).__init__(rabbitmq, "task", "events", "task_events_"+manager_id)
+        self.events = events
+
+    def message_deliver(self, channel, basic_deliver, properties, body):
+        data = json.loads(body)
+
+        self.events.add(data['events'])
 
         channel.basic_ack(basic_deliver.delivery_tag)
@@ -1,38 +1,34 @@
-from hqlib.rabbitmq.routing import Subscriber as RoutingSubscriber
-from hqlib.rabbitmq.rpc import RPCReplyPublisher
+from hqmanager.messaging.pool import PooledSubscriber
+from hqmanager.messaging.broadcast import BroadcastSubscriber
 import json
 
 
-class Validate(RoutingSubscriber):
+class Validate(PooledSubscriber):
 
-    def __init__(self, rabbitmq, assignment):
-        super(Validate, self).__init__(rabbitmq, "security", "validate", queue_name="security_validate", qos=1)
+    def __init__(self, rabbitmq, assignment, concurrency=1, publishers=None):
+        super(Validate, self).__init__(rabbitmq, "security", "validate", queue_name="security_validate",
+                                       concurrency=concurrency, publishers=publishers)
         self.assignment = assignment
 
-    def message_deliver(self, channel, basic_deliver, properties, body):
+    def handle_message(self, channel, basic_deliver, properties, body):
         data = json.loads(body)
 
-        publisher = RPCReplyPublisher(self.rabbitmq, properties.reply_to, properties.correlation_id)
+        reply = self.assignment.validate_request(data['token'], data.get('permission'))
+
+        self.reply(channel, basic_deliver, properties, reply)
 
-        token = data['token']
 
-        if self.assignment.validate_token(token) is False:
-            publisher.publish({"code": 403, "error": "Invalid API Token"})
-            publisher.close()
-            channel.basic_ack(basic_deliver.delivery_tag)
-            return
+class InvalidateTokens(BroadcastSubscriber):
 
-        if 'permission' in data:
-            if not self.assignment.has_permission_token(token, data['permission']):
-                publisher.publish({"code": 403, "error": "Invalid user permissions"})
-                publisher.close()
-                channel.basic_ack(basic_deliver.delivery_tag)
-                return
+    def __init__(self, rabbitmq, assignment, manager_id):
+        # Every manager binds its own queue so each one sees every invalidation
+        super(InvalidateTokens, self).__init__(rabbitmq, "security", "invalidate",
+                                               "security_invalidate_"+manager_id)
+        self.assignment = assignment
 
-        username = self.assignment.get_username_from_token(token)
-        user_id = self.assignment.get_assignment_id(username)
+    def message_deliver(self, channel, basic_deliver, properties, body):
+        data = json.loads(body)
 
-        publisher.publish({"code": 200, "user": {'id': user_id, 'name': username}})
-        publisher.close()
+        self.assignment.invalidate_local(data.get('username'))
 
         channel.basic_ack(basic_deliver.delivery_tag)
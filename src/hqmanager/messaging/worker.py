@@ -1,29 +1,220 @@
-from hqlib.rabbitmq.routing import Subscriber as RoutingSubscriber
+from hqmanager.messaging.pool import PooledSubscriber, WorkerPool, ThreadSafeChannel
+from hqmanager.messaging.batch import MessageBatcher
+from hqmanager.messaging.publisher import reply_message
+from hqmanager.messaging.broadcast import BroadcastSubscriber
 from hqlib.rabbitmq.routing import Publisher as RoutingPublisher
-from hqlib.rabbitmq.rpc import RPCReplyPublisher
 import json
 from hqlib.sql.models import Worker
+from hqmanager.serializers import worker_messages
+from hqmanager.worker_directory import tag_pairs, string_types
+
+
+def worker_key(body):
+    """The (target, framework) a message is about, None if it is malformed so handle_message can drop it."""
+    try:
+        data = json.loads(body)
+        key = (data['target'], data['framework'])
+        hash(key)
+        return key
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def parse_registration(body):
+    """Return the data of a worker register message, None if it is malformed."""
+    try:
+        data = json.loads(body)
+
+        for field in ('target', 'framework', 'datacenter'):
+            if not isinstance(data[field], string_types):
+                return None
+
+        if data['tags'] is not None and not isinstance(data['tags'], dict):
+            return None
+    except (ValueError, KeyError, TypeError):
+        return None
+
+    return data
 
 
 class WorkerRunTask(RoutingPublisher):
 
-    def __init__(self, rabbitmq, worker):
-        super(WorkerRunTask, self).__init__(rabbitmq, "worker-"+worker.target, "run-"+worker.framework)
+    def __init__(self, rabbitmq, target, framework):
+        super(WorkerRunTask, self).__init__(rabbitmq, "worker-"+target, "run-"+framework)
 
     def run(self, task):
         self.publish(task)
         self.close()
 
 
-class WorkerRegister(RoutingSubscriber):
+class WorkerLiveness(object):
+    """Checks workers are alive without blocking the caller.
+
+    Workers with a recent heartbeat in the registry are alive straight away, the
+    rest are probed with their alive rpc. A probe holds no thread while it waits, the
+    rpc client calls back when the reply arrives or when its expiry thread expires the
+    call. Each check calls back exactly once, with an error if the worker did not
+    answer before the timeout, on one of size threads so the database work launches
+    finish with never holds up the rpc reply thread.
+    """
+
+    def __init__(self, rpc, heartbeats, size=16, timeout=10):
+        self.rpc = rpc
+        self.heartbeats = heartbeats
+        self.timeout = timeout
+        self.pool = WorkerPool(size, "worker_alive")
+
+    def check(self, target, framework, callback):
+        """Calls callback(error) with error None if the worker is alive."""
+        if self.heartbeats.is_alive(target, framework):
+            callback(None)
+            return
+
+        def replied(data):
+            if data is None:
+                self.pool.submit(lambda: callback("Worker did not reply in time it is dead"))
+                return
+
+            self.heartbeats.seen(target, framework)
+            self.pool.submit(lambda: callback(None))
+
+        self.rpc.send("worker-"+target, "alive-"+framework, {}, callback=replied, timeout=self.timeout)
+
+    def stop(self):
+        self.pool.stop()
 
-    def __init__(self, rabbitmq, database):
-        super(WorkerRegister, self).__init__(rabbitmq, "worker", "register", queue_name="worker_register", qos=1)
+
+class WorkerHeartbeat(BroadcastSubscriber):
+
+    def __init__(self, rabbitmq, heartbeats, manager_id):
+        # Every manager binds its own queue so each one sees every heartbeat
+        super(WorkerHeartbeat, self).__init__(rabbitmq, "worker", "heartbeat", "worker_heartbeat_"+manager_id)
+        self.heartbeats = heartbeats
+
+    def message_deliver(self, channel, basic_deliver, properties, body):
+        try:
+            data = json.loads(body)
+            self.heartbeats.beat(data['target'], data['framework'], data.get('load'))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.logger.warning("Dropping invalid worker heartbeat message")
+
+        channel.basic_ack(basic_deliver.delivery_tag)
+
+
+class WorkerRegister(PooledSubscriber):
+    """Registers workers and replies with their ids.
+
+    With a batch_size above 1 registrations are buffered for up to batch_window
+    seconds or batch_size messages and written in one transaction: one select finds
+    the workers that already exist, the rest are inserted together, and every rpc in
+    the batch is answered on one publishing channel.
+    """
+
+    def __init__(self, rabbitmq, database, directory, concurrency=1, batch_size=1, batch_window=0.05,
+                 publishers=None):
+        prefetch = None
+        if batch_size > 1:
+            # Acks for a batch are sent in delivery order so it has to be consumed on one thread
+            concurrency = 1
+            prefetch = batch_size * 2
+
+        super(WorkerRegister, self).__init__(rabbitmq, "worker", "register", queue_name="worker_register",
+                                             concurrency=concurrency, prefetch=prefetch, publishers=publishers)
         self.database = database
+        self.directory = directory
+        self.batcher = None
+
+        if batch_size > 1:
+            self.batcher = MessageBatcher(batch_size, batch_window, self.flush_registrations, "worker_register")
 
     def message_deliver(self, channel, basic_deliver, properties, body):
+        if self.batcher is None:
+            super(WorkerRegister, self).message_deliver(channel, basic_deliver, properties, body)
+            return
 
-        data = json.loads(body)
+        data = parse_registration(body)
+
+        # Bad messages are dropped here so they never fail, and requeue, a whole batch
+        if data is None:
+            self.logger.warning("Dropping invalid worker register message "+repr(body[:200]))
+            channel.basic_ack(basic_deliver.delivery_tag)
+            return
+
+        self.batcher.add((ThreadSafeChannel(channel), basic_deliver, properties, data))
+
+    def flush_registrations(self, batch):
+        (channel, last_deliver, _, _) = batch[-1]
+
+        # The last registration of a worker in the batch wins
+        registrations = {}
+        for (_, _, _, data) in batch:
+            registrations[(data['target'], data['framework'])] = data
+
+        try:
+            with self.database.session() as session:
+                targets = set(target for (target, _) in registrations)
+                frameworks = set(framework for (_, framework) in registrations)
+
+                existing = session.query(Worker).filter(Worker.target.in_(targets)).\
+                    filter(Worker.framework.in_(frameworks)).filter(Worker.deleted == False).with_for_update()
+
+                workers = {}
+                for worker in existing:
+                    key = (worker.target, worker.framework)
+
+                    if key in registrations:
+                        worker.tags = registrations[key]['tags']
+                        workers[key] = worker
+
+                for (key, data) in registrations.items():
+                    if key not in workers:
+                        workers[key] = Worker(target=data['target'], framework=data['framework'],
+                                              datacenter=data['datacenter'], tags=data['tags'])
+                        session.add(workers[key])
+
+                session.flush()
+                ids = dict((key, worker.id) for (key, worker) in workers.items())
+                session.commit()
+
+                # Reload every registered worker with one query for the directory
+                for worker in session.query(Worker).filter(Worker.id.in_(list(ids.values()))):
+                    self.directory.put(worker)
+        except Exception:
+            self.logger.exception("Error flushing worker registrations, requeueing "+str(len(batch)))
+            channel.basic_nack(last_deliver.delivery_tag, multiple=True, requeue=True)
+            return
+
+        self.directory.changed_many(list(ids.values()))
+
+        replies = [reply_message(properties.reply_to, properties.correlation_id,
+                                 {"id": str(ids[(data['target'], data['framework'])])})
+                   for (_, _, properties, data) in batch]
+
+        try:
+            self.publishers.publish_batch(replies)
+        except Exception:
+            # The workers are registered, callers that missed their reply will retry and get the same ids
+            self.logger.exception("Error replying to "+str(len(replies))+" worker registrations")
+
+        channel.basic_ack(last_deliver.delivery_tag, multiple=True)
+
+    def stop(self):
+        super(WorkerRegister, self).stop()
+
+        if self.batcher is not None:
+            self.batcher.stop()
+
+    # Keep messages for the same worker in order
+    def message_key(self, properties, body):
+        return worker_key(body)
+
+    def handle_message(self, channel, basic_deliver, properties, body):
+        data = parse_registration(body)
+
+        if data is None:
+            self.logger.warning("Dropping invalid worker register message "+repr(body[:200]))
+            channel.basic_ack(basic_deliver.delivery_tag)
+            return
 
         with self.database.session() as session:
             worker = session.query(Worker).filter(Worker.target == data['target']).\
@@ -36,21 +227,26 @@ class WorkerRegister(RoutingSubscriber):
                                 tags=data['tags'])
                 session.add(worker)
             session.commit()
+            worker_id = worker.id
+            self.directory.put(worker)
 
-            publisher = RPCReplyPublisher(self.rabbitmq, properties.reply_to, properties.correlation_id)
-            publisher.publish({"id": str(worker.id)})
-            publisher.close()
-
-        channel.basic_ack(basic_deliver.delivery_tag)
+        self.directory.changed(worker_id)
+        self.reply(channel, basic_deliver, properties, {"id": str(worker_id)})
 
 
-class WorkerReload(RoutingSubscriber):
+class WorkerReload(PooledSubscriber):
 
-    def __init__(self, rabbitmq, database):
-        super(WorkerReload, self).__init__(rabbitmq, "worker", "reload", queue_name="worker_reload", qos=1)
+    def __init__(self, rabbitmq, database, directory, concurrency=1, publishers=None):
+        super(WorkerReload, self).__init__(rabbitmq, "worker", "reload", queue_name="worker_reload",
+                                           concurrency=concurrency, publishers=publishers)
         self.database = database
+        self.directory = directory
 
-    def message_deliver(self, channel, basic_deliver, properties, body):
+    # Keep messages for the same worker in order
+    def message_key(self, properties, body):
+        return worker_key(body)
+
+    def handle_message(self, channel, basic_deliver, properties, body):
         data = json.loads(body)
 
         with self.database.session() as session:
@@ -60,35 +256,42 @@ class WorkerReload(RoutingSubscriber):
             if worker is not None:
                 worker.tags = data['tags']
                 session.commit()
+                self.directory.put(worker)
+                self.directory.changed(worker.id)
 
         channel.basic_ack(basic_deliver.delivery_tag)
 
 
-class WorkerGet(RoutingSubscriber):
+class WorkerGet(PooledSubscriber):
 
-    def __init__(self, rabbitmq, database):
-        super(WorkerGet, self).__init__(rabbitmq, "worker", "get", queue_name="worker_get", qos=1)
-        self.database = database
+    def __init__(self, rabbitmq, directory, concurrency=1, publishers=None):
+        super(WorkerGet, self).__init__(rabbitmq, "worker", "get", queue_name="worker_get",
+                                        concurrency=concurrency, publishers=publishers)
+        self.directory = directory
 
-    def message_deliver(self, channel, basic_deliver, properties, body):
+    def handle_message(self, channel, basic_deliver, properties, body):
         data = json.loads(body)
 
-        workers = []
+        # Optional {key: value} tags every worker in the reply has to have
+        workers = self.directory.find(framework=data['framework'], datacenter=data['datacenter'],
+                                      tags=list(tag_pairs(data.get('tags'))))
+
+        self.reply(channel, basic_deliver, properties, {'workers': worker_messages(workers)})
 
-        with self.database.session() as session:
-            worker_objects = session.query(Worker).filter(Worker.framework == data['framework']).\
-                filter(Worker.datacenter == data['datacenter']).filter(Worker.deleted == False)
 
-            for worker in worker_objects:
-                data = {'id': worker.id,
-                        'target': worker.target,
-                        'framework': worker.framework,
-                        'tags': worker.tags}
+class WorkerChanged(BroadcastSubscriber):
 
-                workers.append(data)
+    def __init__(self, rabbitmq, directory, manager_id):
+        # Every manager binds its own queue so each one sees every change
+        super(WorkerChanged, self).__init__(rabbitmq, "worker", "changed", "worker_changed_"+manager_id)
+        self.directory = directory
+        self.manager_id = manager_id
+
+    def message_deliver(self, channel, basic_deliver, properties, body):
+        data = json.loads(body)
 
-        publisher = RPCReplyPublisher(self.rabbitmq, properties.reply_to, properties.correlation_id)
-        publisher.publish({'workers': workers})
-        publisher.close()
+        # The manager that made the change already updated its own directory
+        if data.get('manager') != self.manager_id:
+            self.directory.refresh(data['id'])
 
         channel.basic_ack(basic_deliver.delivery_tag)
@@ -0,0 +1,16 @@
+from sqlalchemy import Column, Integer, ForeignKey
+from hqlib.sql import Base
+from hqlib.sql.models import Job
+
+
+class JobProgress(Base):
+    """How many of a job's tasks are in each status, kept up to date by the task status transitions."""
+    __tablename__ = 'job_progress'
+
+    job_id = Column(Job.__table__.c.id.type, ForeignKey(Job.__table__.c.id), primary_key=True, autoincrement=False)
+    pending = Column(Integer, nullable=False, default=0)
+    starting = Column(Integer, nullable=False, default=0)
+    running = Column(Integer, nullable=False, default=0)
+    finished = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    lost = Column(Integer, nullable=False, default=0)
@@ -10,5 +10,7 @@ parser = argparse.ArgumentParser(
     epilog=epilog)
 
 parser.add_argument('-c', '--config', required=True, help='Config file to use')
+parser.add_argument('--repair-progress', action='store_true',
+                    help='Recount every job\'s progress counters from its tasks and exit')
 parser.set_defaults(func=hqmanager.main)
 # args = parser.parse_args()
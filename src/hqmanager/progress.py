@@ -0,0 +1,129 @@
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from hqlib.sql.models import Task, TaskStatus, JobTarget
+from hqmanager.models import JobProgress
+
+# TaskStatus -> JobProgress column
+COLUMNS = dict((getattr(TaskStatus, column.upper()), column)
+               for column in ('pending', 'starting', 'running', 'finished', 'failed', 'lost'))
+
+
+def count_tasks(session, job_ids=None):
+    """Count the tasks of each job per status from the tasks themselves, job id -> {column: count}."""
+    query = session.query(JobTarget.job_id, Task.status, func.count(Task.id)).\
+        join(Task, Task.job_target_id == JobTarget.id)
+
+    if job_ids is not None:
+        query = query.filter(JobTarget.job_id.in_(job_ids))
+
+    counts = {}
+    for (job_id, status, count) in query.group_by(JobTarget.job_id, Task.status):
+        if status in COLUMNS:
+            counts.setdefault(job_id, {})[COLUMNS[status]] = count
+
+    return counts
+
+
+def drifted(session, job_ids):
+    """Return the jobs in job_ids whose counters went below zero.
+
+    The counters only follow the transitions the manager makes. Tasks added to a job
+    after its counters were created and statuses set by anything else (LOST) are not
+    in them, and once enough of those tasks have moved on a counter goes negative.
+    """
+    negative = or_(*[getattr(JobProgress, column) < 0 for column in COLUMNS.values()])
+    return set(job_id for (job_id,) in session.query(JobProgress.job_id).
+               filter(JobProgress.job_id.in_(job_ids)).filter(negative))
+
+
+def record_progress(session, changes):
+    """Apply task transitions to their jobs' counters inside the caller's transaction.
+
+    changes is a list of (job_id, old_status, new_status). A job without counters yet
+    gets them counted from its tasks, which already include these changes, and so
+    does a job whose counters have drifted below zero.
+    """
+    deltas = {}
+
+    for (job_id, old, new) in changes:
+        if job_id is None or old == new:
+            continue
+
+        job = deltas.setdefault(job_id, {})
+        job[old] = job.get(old, 0) - 1
+        job[new] = job.get(new, 0) + 1
+
+    # Jobs are updated in id order so two batches touching the same jobs can't deadlock
+    for job_id in sorted(deltas):
+        delta = deltas[job_id]
+        values = {}
+
+        for (status, count) in delta.items():
+            if count != 0 and status in COLUMNS:
+                column = getattr(JobProgress, COLUMNS[status])
+                values[column] = column + count
+
+        if len(values) == 0:
+            continue
+
+        progress = session.query(JobProgress).filter(JobProgress.job_id == job_id)
+
+        if progress.update(values, synchronize_session=False) == 0:
+            try:
+                with session.begin_nested():
+                    session.add(JobProgress(job_id=job_id, **count_tasks(session, [job_id]).get(job_id, {})))
+            except IntegrityError:
+                # Another transaction counted the job first from what was committed, add this one's changes
+                progress.update(values, synchronize_session=False)
+
+    if len(deltas) == 0:
+        return
+
+    repaired = sorted(drifted(session, list(deltas)))
+    counts = count_tasks(session, repaired) if len(repaired) > 0 else {}
+
+    for job_id in repaired:
+        job_counts = counts.get(job_id, {})
+        session.query(JobProgress).filter(JobProgress.job_id == job_id).\
+            update(dict((getattr(JobProgress, column), job_counts.get(column, 0)) for column in COLUMNS.values()),
+                   synchronize_session=False)
+
+
+def progress_dict(counts):
+    data = dict((column, counts.get(column, 0)) for column in COLUMNS.values())
+    data['total'] = sum(data.values())
+    return data
+
+
+def read_progress(session, job_ids):
+    """Return job id -> progress dict with one row read per job.
+
+    Jobs without counters, or with a counter below zero, are counted from their tasks.
+    """
+    if len(job_ids) == 0:
+        return {}
+
+    columns = [getattr(JobProgress, column) for column in COLUMNS.values()]
+    progress = {}
+
+    for row in session.query(JobProgress.job_id, *columns).filter(JobProgress.job_id.in_(job_ids)):
+        if min(row[1:]) >= 0:
+            progress[row[0]] = progress_dict(dict(zip(COLUMNS.values(), row[1:])))
+
+    missing = [job_id for job_id in job_ids if job_id not in progress]
+
+    if len(missing) > 0:
+        for (job_id, counts) in count_tasks(session, missing).items():
+            progress[job_id] = progress_dict(counts)
+
+    return progress
+
+
+def repair_progress(session):
+    """Recount every job's counters from its tasks and return how many jobs have counters. The caller commits."""
+    counts = count_tasks(session)
+
+    session.query(JobProgress).delete(synchronize_session=False)
+    session.add_all([JobProgress(job_id=job_id, **job_counts) for (job_id, job_counts) in counts.items()])
+
+    return len(counts)
@@ -0,0 +1,218 @@
+import datetime
+from sqlalchemy import func
+from hqlib.sql.models import Task, Job, JobTarget, Worker
+from hqmanager.models import JobProgress
+from hqmanager.progress import COLUMNS, read_progress, progress_dict
+
+# Serializers select only the columns a response needs as plain tuples instead of
+# loading ORM objects and build the response dicts in one pass over the rows.
+
+EPOCH = datetime.datetime.utcfromtimestamp(0)
+
+TASK_COLUMNS = (Task.id, Task.name, Task.status, Task.created_at, Task.updated_at, Task.stopped_at)
+JOB_COLUMNS = (Job.id, Job.name, Job.status, Job.datacenter, Job.created_at, Job.updated_at, Job.stopped_at)
+
+
+def millis(values):
+    """Convert datetimes to unix millis in bulk, None stays None."""
+    epoch = EPOCH
+    return [None if value is None else int((value.replace(tzinfo=None) - epoch).total_seconds() * 1000.0)
+            for value in values]
+
+
+def task_actions(session, task_ids):
+    """Return task id -> list of action dicts for every task in task_ids with one query."""
+    actions = {}
+
+    if len(task_ids) == 0:
+        return actions
+
+    action = Task.actions.property.mapper
+    rows = session.query(Task.id, action.c.processor, action.c.arguments).join(Task.actions).\
+        filter(Task.id.in_(task_ids)).order_by(Task.id, *action.primary_key)
+
+    for (task_id, processor, arguments) in rows:
+        data = {'processor': processor}
+        if arguments is not None:
+            data['arguments'] = arguments
+        actions.setdefault(task_id, []).append(data)
+
+    return actions
+
+
+def task_dicts(session, query):
+    """Serialize the tasks a Task query returns, keeping its filters, order and limit."""
+    rows = query.with_entities(*TASK_COLUMNS).all()
+    actions = task_actions(session, [row[0] for row in rows])
+    created = millis(row[3] for row in rows)
+    updated = millis(row[4] for row in rows)
+    stopped = millis(row[5] for row in rows)
+
+    tasks = []
+
+    for (i, (task_id, name, status, _, _, _)) in enumerate(rows):
+        data = {'id': task_id,
+                'name': name,
+                'status': status.value,
+                'actions': actions.get(task_id, []),
+                'created_at': created[i],
+                'updated_at': updated[i]}
+
+        if stopped[i] is not None:
+            data['stopped_at'] = stopped[i]
+
+        tasks.append(data)
+
+    return tasks
+
+
+def job_dict(session, job_id):
+    """Serialize a job with its progress, targets and their tasks in three queries, None if there is no such job.
+
+    The progress is counted from the tasks the job is serialized with, so it is exact
+    even when the job's counters have drifted.
+    """
+    row = session.query(*JOB_COLUMNS).filter(Job.id == job_id).first()
+
+    if row is None:
+        return None
+
+    (job_id, name, status, datacenter, created_at, updated_at, stopped_at) = row
+    (created_at, updated_at, stopped_at) = millis([created_at, updated_at, stopped_at])
+
+    data = {'id': job_id,
+            'name': name,
+            'status': status.value,
+            'datacenter': datacenter,
+            'targets': [],
+            'progress': None,
+            'created_at': created_at,
+            'updated_at': updated_at}
+
+    targets = session.query(JobTarget.id, Worker.target, JobTarget.tags).join(JobTarget.worker).\
+        filter(JobTarget.job_id == job_id).order_by(JobTarget.id)
+
+    tasks = session.query(Task.job_target_id, Task.id, Task.status).\
+        join(JobTarget, Task.job_target_id == JobTarget.id).filter(JobTarget.job_id == job_id).order_by(Task.id)
+
+    target_tasks = {}
+    counts = {}
+    for (job_target_id, task_id, task_status) in tasks:
+        target_tasks.setdefault(job_target_id, []).append({'id': task_id, 'status': task_status.value})
+
+        if task_status in COLUMNS:
+            counts[COLUMNS[task_status]] = counts.get(COLUMNS[task_status], 0) + 1
+
+    data['progress'] = progress_dict(counts)
+
+    for (job_target_id, target, tags) in targets:
+        target_data = {'target': target, 'tasks': target_tasks.get(job_target_id, [])}
+        if tags is not None:
+            target_data['tags'] = tags
+        data['targets'].append(target_data)
+
+    if stopped_at is not None:
+        data['stopped_at'] = stopped_at
+
+    return data
+
+
+def job_summaries(session, query):
+    """Summarize the jobs a Job query returns with their progress counters.
+
+    Two queries however many jobs and tasks there are: the job columns and one
+    progress row per job.
+    """
+    rows = query.with_entities(*JOB_COLUMNS).all()
+
+    if len(rows) == 0:
+        return []
+
+    progress = read_progress(session, [row[0] for row in rows])
+
+    created = millis(row[4] for row in rows)
+    updated = millis(row[5] for row in rows)
+    stopped = millis(row[6] for row in rows)
+
+    jobs = []
+
+    for (i, (job_id, name, status, datacenter, _, _, _)) in enumerate(rows):
+        data = {'id': job_id,
+                'name': name,
+                'status': status.value,
+                'datacenter': datacenter,
+                'progress': progress.get(job_id, progress_dict({})),
+                'created_at': created[i],
+                'updated_at': updated[i]}
+
+        if stopped[i] is not None:
+            data['stopped_at'] = stopped[i]
+
+        jobs.append(data)
+
+    return jobs
+
+
+def job_version(session, job_id):
+    """Return (version, finished) for a job with one query, None if there is no such job.
+
+    The version is a tuple of the latest updated_at of the job and its tasks in unix millis,
+    the job status, how many tasks it has and its progress counters. Timestamps alone can't
+    tell apart changes within the same second on databases that store whole seconds. The
+    counters only follow the manager's own transitions, the task count is what changes
+    when tasks are added to the job.
+    """
+    tasks = session.query(Task.id).join(JobTarget, Task.job_target_id == JobTarget.id).\
+        filter(JobTarget.job_id == Job.id).correlate(Job)
+    latest_task = tasks.with_entities(func.max(Task.updated_at)).as_scalar()
+    task_count = tasks.with_entities(func.count(Task.id)).as_scalar()
+
+    counts = [getattr(JobProgress, column) for column in sorted(COLUMNS.values())]
+
+    row = session.query(Job.updated_at, Job.stopped_at, latest_task, Job.status, task_count, *counts).\
+        outerjoin(JobProgress, JobProgress.job_id == Job.id).filter(Job.id == job_id).first()
+
+    if row is None:
+        return None
+
+    (updated_at, stopped_at, task_updated_at, status) = row[:4]
+    latest = max([0] + [value for value in millis([updated_at, task_updated_at]) if value is not None])
+
+    return (latest, status.value) + tuple(row[4:]), stopped_at is not None
+
+
+def worker_dicts(workers, heartbeats):
+    """Serialize worker directory entries for the API with their heartbeat state."""
+    workers = list(workers)
+    created = millis(worker.created_at for worker in workers)
+    updated = millis(worker.updated_at for worker in workers)
+
+    result = []
+
+    for (i, worker) in enumerate(workers):
+        data = {'id': worker.id,
+                'target': worker.target,
+                'framework': worker.framework,
+                'datacenter': worker.datacenter,
+                'tags': worker.tags,
+                'created_at': created[i],
+                'updated_at': updated[i],
+                'last_seen': None,
+                'load': None,
+                'alive': heartbeats.is_alive(worker.target, worker.framework)}
+
+        heartbeat = heartbeats.get(worker.target, worker.framework)
+
+        if heartbeat is not None:
+            data['last_seen'] = int(heartbeat[0] * 1000)
+            data['load'] = heartbeat[1]
+
+        result.append(data)
+
+    return result
+
+
+def worker_messages(workers):
+    """Serialize worker directory entries for a worker.get reply."""
+    return [{'id': worker.id, 'target': worker.target, 'framework': worker.framework, 'tags': worker.tags}
+            for worker in workers]
@@ -0,0 +1,109 @@
+from sqlalchemy import update
+from hqlib.sql.models import TaskStatus, Task, JobTarget
+from hqmanager.progress import record_progress
+
+# The statuses a task may move to each status from, None means from any status
+TRANSITIONS = {
+    TaskStatus.STARTING: (TaskStatus.PENDING, TaskStatus.LOST),
+    TaskStatus.RUNNING: (TaskStatus.STARTING, TaskStatus.RUNNING),
+    TaskStatus.FINISHED: (TaskStatus.RUNNING,),
+    TaskStatus.FAILED: None
+}
+
+
+def can_transition(current, status):
+    allowed = TRANSITIONS.get(status, ())
+    return allowed is None or current in allowed
+
+
+def sources(status):
+    """The statuses a task may move to status from, status itself first.
+
+    A task moved by an earlier update from another status already has status, so
+    running the update from status first keeps it from being matched twice.
+    """
+    allowed = TRANSITIONS.get(status, ())
+
+    if allowed is None:
+        allowed = list(TaskStatus)
+
+    return sorted(allowed, key=lambda source: source != status)
+
+
+def read_tasks(session, task_ids):
+    """Return id -> (status, job_id) for the tasks in task_ids as they are now, without locking them."""
+    rows = session.query(Task.id, Task.status, JobTarget.job_id).\
+        outerjoin(JobTarget, Task.job_target_id == JobTarget.id).filter(Task.id.in_(task_ids))
+
+    return dict((task_id, (status, job_id)) for (task_id, status, job_id) in rows)
+
+
+def move(session, task_ids, old, status, values):
+    """Move the tasks in task_ids that have status old to status and return the ids that moved.
+
+    One conditional UPDATE ... RETURNING on databases that have it, otherwise one
+    conditional UPDATE per task so each one's rowcount says whether it moved.
+    """
+    values = dict(values, status=status)
+    changes = dict((getattr(Task, column), value) for (column, value) in values.items())
+
+    if session.get_bind().dialect.implicit_returning:
+        statement = update(Task.__table__).where(Task.id.in_(task_ids)).where(Task.status == old).\
+            values(changes).returning(Task.id)
+        return set(task_id for (task_id,) in session.execute(statement))
+
+    moved = set()
+    for task_id in task_ids:
+        if session.query(Task).filter(Task.id == task_id).filter(Task.status == old).\
+                update(changes, synchronize_session=False) > 0:
+            moved.add(task_id)
+
+    return moved
+
+
+def transition(session, task_id, status, **values):
+    """Move a task to status if its current status allows it.
+
+    Returns True if the task changed. The caller commits.
+    """
+    return len(transition_many(session, [task_id], status, **values)) > 0
+
+
+def transition_many(session, task_ids, status, **values):
+    """Move every task in task_ids whose current status allows it to status and return the ids that moved.
+
+    Nothing is locked. Each task is moved by an UPDATE conditional on the status it
+    was read with, so the status every moved task came from is known exactly and its
+    job's progress counters are updated in the same transaction. A task that changed
+    between the read and its update is tried again from every status it may move from.
+    """
+    if len(task_ids) == 0:
+        return set()
+
+    tasks = read_tasks(session, task_ids)
+    moved = {}
+    missed = []
+
+    for old in sources(status):
+        ids = [task_id for (task_id, (current, _)) in tasks.items() if current == old]
+
+        if len(ids) == 0:
+            continue
+
+        for task_id in move(session, ids, old, status, values):
+            moved[task_id] = old
+
+        missed.extend(task_id for task_id in ids if task_id not in moved)
+
+    for old in sources(status):
+        if len(missed) == 0:
+            break
+
+        for task_id in move(session, missed, old, status, values):
+            moved[task_id] = old
+
+        missed = [task_id for task_id in missed if task_id not in moved]
+
+    record_progress(session, [(tasks[task_id][1], old, status) for (task_id, old) in moved.items()])
+
+    return set(moved)
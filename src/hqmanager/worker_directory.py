@@ -0,0 +1,210 @@
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from hqlib.sql.models import Worker
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+WorkerEntry = namedtuple('WorkerEntry', ['id', 'target', 'framework', 'datacenter', 'tags', 'created_at',
+                                         'updated_at'])
+
+
+def worker_entry(worker):
+    return WorkerEntry(worker.id, worker.target, worker.framework, worker.datacenter, dict(worker.tags or {}),
+                       worker.created_at, worker.updated_at)
+
+
+def tag_pairs(tags):
+    """The (key, value) pairs a worker is indexed under, non string values are indexed as json."""
+    for (key, value) in (tags or {}).items():
+        if not isinstance(value, string_types):
+            value = json.dumps(value, sort_keys=True)
+
+        yield key, value
+
+
+class WorkerDirectory(object):
+    """In memory copy of the workers that are not deleted.
+
+    Workers are indexed by (framework, datacenter), target and tag (key, value) so
+    lookups only touch the workers they return. The directory is loaded from the
+    database once and kept up to date by the manager that changes a worker, which
+    broadcasts the worker id so every other manager reloads that one worker.
+    """
+
+    def __init__(self, database, publishers=None, manager_id=None):
+        self.logger = logging.getLogger("hq.manager.worker_directory")
+        self.database = database
+        self.publishers = publishers
+        self.manager_id = manager_id
+        self.lock = threading.Lock()
+        self.workers = {}
+        self.by_location = {}
+        self.by_target = {}
+        self.by_tag = {}
+        # Bumped by every put or remove, worker id -> version of its last change
+        self.version = 0
+        self.updates = {}
+
+    def load(self):
+        with self.lock:
+            started = self.version
+
+        with self.database.session() as session:
+            entries = [worker_entry(worker) for worker in session.query(Worker).filter(Worker.deleted == False)]
+
+        with self.lock:
+            # Workers put or removed while the snapshot was read are newer than it
+            recent = dict((worker_id, self.workers.get(worker_id)) for (worker_id, version) in self.updates.items()
+                          if version > started)
+
+            self.workers = {}
+            self.by_location = {}
+            self.by_target = {}
+            self.by_tag = {}
+
+            for entry in entries:
+                if entry.id not in recent:
+                    self.index(entry)
+
+            for entry in recent.values():
+                if entry is not None:
+                    self.index(entry)
+
+            self.updates = dict((worker_id, self.updates[worker_id]) for worker_id in recent)
+
+        self.logger.info("Loaded " + str(len(entries)) + " workers")
+
+    def reload_every(self, interval):
+        """Reload the whole directory every interval seconds in case a change broadcast was missed."""
+        def run():
+            while True:
+                time.sleep(interval)
+
+                try:
+                    self.load()
+                except Exception:
+                    self.logger.exception("Error reloading workers")
+
+        thread = threading.Thread(target=run, name="worker-directory-reload")
+        thread.daemon = True
+        thread.start()
+
+    def touch(self, worker_id):
+        self.version += 1
+        self.updates[worker_id] = self.version
+
+    def index(self, entry):
+        self.workers[entry.id] = entry
+        self.by_location.setdefault((entry.framework, entry.datacenter), set()).add(entry.id)
+        self.by_target.setdefault(entry.target, set()).add(entry.id)
+
+        for pair in tag_pairs(entry.tags):
+            self.by_tag.setdefault(pair, set()).add(entry.id)
+
+    def unindex(self, worker_id):
+        entry = self.workers.pop(worker_id, None)
+
+        if entry is None:
+            return
+
+        self.discard(self.by_location, (entry.framework, entry.datacenter), worker_id)
+        self.discard(self.by_target, entry.target, worker_id)
+
+        for pair in tag_pairs(entry.tags):
+            self.discard(self.by_tag, pair, worker_id)
+
+    def discard(self, index, key, worker_id):
+        ids = index.get(key)
+
+        if ids is None:
+            return
+
+        ids.discard(worker_id)
+
+        if len(ids) == 0:
+            del index[key]
+
+    def put(self, worker):
+        """Add or replace a worker from its model."""
+        entry = worker_entry(worker)
+
+        with self.lock:
+            self.touch(entry.id)
+            self.unindex(entry.id)
+            self.index(entry)
+
+    def remove(self, worker_id):
+        with self.lock:
+            self.touch(worker_id)
+            self.unindex(worker_id)
+
+    def get(self, worker_id):
+        with self.lock:
+            return self.workers.get(worker_id)
+
+    def find(self, framework=None, datacenter=None, target=None, tags=None):
+        """Return the entries matching every filter given, ordered by id.
+
+        framework and datacenter use the location index when both are given, tags is a
+        list of (key, value) pairs a worker must all have.
+        """
+        with self.lock:
+            candidates = []
+
+            if framework is not None and datacenter is not None:
+                candidates.append(self.by_location.get((framework, datacenter), set()))
+
+            if target is not None:
+                candidates.append(self.by_target.get(target, set()))
+
+            for pair in tags or []:
+                candidates.append(self.by_tag.get(pair, set()))
+
+            if len(candidates) > 0:
+                candidates.sort(key=len)
+                ids = candidates[0].intersection(*candidates[1:])
+            else:
+                ids = self.workers.keys()
+
+            entries = [self.workers[worker_id] for worker_id in ids]
+
+        if framework is not None:
+            entries = [entry for entry in entries if entry.framework == framework]
+
+        if datacenter is not None:
+            entries = [entry for entry in entries if entry.datacenter == datacenter]
+
+        return sorted(entries, key=lambda entry: entry.id)
+
+    def refresh(self, worker_id):
+        """Reload one worker from the database, dropping it if it is gone or deleted."""
+        with self.database.session() as session:
+            worker = session.query(Worker).filter(Worker.id == worker_id).filter(Worker.deleted == False).first()
+
+            if worker is None:
+                self.remove(worker_id)
+            else:
+                self.put(worker)
+
+    def changed(self, worker_id):
+        """Tell the other managers a worker changed."""
+        self.changed_many([worker_id])
+
+    def changed_many(self, worker_ids):
+        if self.publishers is None:
+            return
+
+        messages = [("worker", "changed", {'id': worker_id, 'manager': self.manager_id}, None)
+                    for worker_id in worker_ids]
+
+        try:
+            self.publishers.publish_batch(messages)
+        except Exception:
+            self.logger.exception("Error broadcasting change to " + str(len(messages)) + " workers")
@@ -0,0 +1,26 @@
+import importlib
+import pkgutil
+import unittest
+
+import hqmanager
+
+try:
+    import ldap
+except ImportError:
+    ldap = None
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_import_every_module(self):
+        # A module that fails to import stops the daemon from starting
+        for (_, name, _) in pkgutil.walk_packages(hqmanager.__path__, hqmanager.__name__ + "."):
+            # python-ldap is only needed by the ldap drivers
+            if ldap is None and 'ldap' in name:
+                continue
+
+            importlib.import_module(name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import unittest
+
+# python-ldap is only needed by the ldap drivers
+try:
+    import ldap
+except ImportError:
+    ldap = None
+
+if ldap is not None:
+    from hqmanager.ldap_pool import LDAPConnectionPool, LDAPPoolTimeoutException
+
+
+class FakeConnection(object):
+    """Stands in for a bound python-ldap connection, failing the calls it is told to."""
+
+    def __init__(self, number, search_error=None, whoami_error=None):
+        self.number = number
+        self.search_error = search_error
+        self.whoami_error = whoami_error
+        self.whoamis = 0
+        self.unbound = False
+
+    def search_s(self, base, scope, criteria, attributes):
+        if self.search_error is not None:
+            raise self.search_error
+        return [(base, {'connection': [self.number]})]
+
+    def whoami_s(self):
+        self.whoamis += 1
+        if self.whoami_error is not None:
+            raise self.whoami_error
+        return "u:service"
+
+    def unbind(self):
+        self.unbound = True
+
+
+@unittest.skipIf(ldap is None, "python-ldap is not installed")
+class LDAPConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.opened = []
+        self.failures = {}
+
+    def connect(self):
+        connection = FakeConnection(len(self.opened), **self.failures.pop(len(self.opened), {}))
+        self.opened.append(connection)
+        return connection
+
+    def pool(self, size=2, timeout=1, check_interval=30):
+        return LDAPConnectionPool(None, size, timeout, check_interval, connect=self.connect)
+
+    def test_reuses_connections(self):
+        pool = self.pool()
+
+        pool.search_s("dc=a", ldap.SCOPE_SUBTREE, "(cn=*)", None)
+        pool.search_s("dc=a", ldap.SCOPE_SUBTREE, "(cn=*)", None)
+
+        self.assertEqual(len(self.opened), 1)
+
+    def test_healthy_idle_connection_is_kept(self):
+        pool = self.pool(check_interval=0)
+
+        pool.search_s("dc=a", ldap.SCOPE_SUBTREE, "(cn=*)", None)
+        pool.search_s("dc=a", ldap.SCOPE_SUBTREE, "(cn=*)", None)
+
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(self.opened[0].whoamis, 1)
+
+    def test_unhealthy_idle_connection_is_replaced(self):
+        self.failures[0] = {'whoami_error': ldap.SERVER_DOWN()}
+        pool = self.pool(check_interval=0)
+
+        pool.search_s("dc=a", ldap.SCOPE_SUBTREE, "(cn=*)", None)
+        result = pool.search_s("dc=a", ldap.SCOPE_SUBTREE, "(cn=*)", None)
+
+        self.assertTrue(self.opened[0].unbound)
+        self.assertEqual(result, [("dc=a", {'connection': [1]})])
+
+    def test_search_retries_once_on_a_new_connection(self):
+        self.failures[0] = {'search_error': ldap.SERVER_DOWN()}
+        pool = self.pool()
+
+        result = pool.search_s("dc=a", ldap.SCOPE_SUBTREE, "(cn=*)", None)
+
+        self.assertTrue(self.opened[0].unbound)
+        self.assertEqual(result, [("dc=a", {'connection': [1]})])
+
+    def test_search_gives_up_after_one_retry(self):
+        self.failures[0] = {'search_error': ldap.SERVER_DOWN()}
+        self.failures[1] = {'search_error': ldap.SERVER_DOWN()}
+        pool = self.pool()
+
+        self.assertRaises(ldap.SERVER_DOWN, pool.search_s, "dc=a", ldap.SCOPE_SUBTREE, "(cn=*)", None)
+
+        # Both broken connections gave their slots back
+        pool.search_s("dc=a", ldap.SCOPE_SUBTREE, "(cn=*)", None)
+        pool.search_s("dc=a", ldap.SCOPE_SUBTREE, "(cn=*)", None)
+        self.assertEqual(len(self.opened), 3)
+
+    def test_other_errors_keep_the_connection(self):
+        self.failures[0] = {'search_error': ldap.NO_SUCH_OBJECT()}
+        pool = self.pool()
+
+        self.assertRaises(ldap.NO_SUCH_OBJECT, pool.search_s, "dc=a", ldap.SCOPE_SUBTREE, "(cn=*)", None)
+
+        self.assertFalse(self.opened[0].unbound)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_failed_connect_gives_the_slot_back(self):
+        pool = LDAPConnectionPool(None, 1, 0.1, connect=self.fail_connect)
+
+        self.assertRaises(ldap.SERVER_DOWN, pool.acquire)
+        self.assertRaises(ldap.SERVER_DOWN, pool.acquire)
+
+    def fail_connect(self):
+        raise ldap.SERVER_DOWN()
+
+    def test_times_out_when_every_connection_is_in_use(self):
+        pool = self.pool(size=1, timeout=0.1)
+
+        pool.acquire()
+
+        self.assertRaises(LDAPPoolTimeoutException, pool.acquire)
+
+    def test_close_unbinds_idle_connections(self):
+        pool = self.pool()
+
+        pool.search_s("dc=a", ldap.SCOPE_SUBTREE, "(cn=*)", None)
+        pool.close()
+
+        self.assertTrue(self.opened[0].unbound)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import datetime
+import unittest
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from hqlib.sql import Base
+from hqlib.sql.models import Job, JobStatus, JobTarget, Task, TaskStatus, Worker
+from hqmanager.api import query_count
+from hqmanager.api.job import JobAPIController
+from hqmanager.api.task import TaskAPIController
+
+
+class Database(object):
+    """The session() interface of hqlib's SQLDB over an in memory sqlite engine."""
+
+    def __init__(self):
+        self.engine = create_engine("sqlite://")
+        Base.metadata.create_all(self.engine)
+        self.sessions = sessionmaker(bind=self.engine)
+
+    @contextmanager
+    def session(self):
+        session = self.sessions()
+        try:
+            yield session
+        finally:
+            session.close()
+
+
+class QueryCountTest(unittest.TestCase):
+    """Serving a job or a page of tasks runs the same number of queries however many rows it has."""
+
+    def setUp(self):
+        query_count.install()
+        self.database = Database()
+        self.job_id = self.add_job(1, 1)
+
+    def add_job(self, targets, tasks):
+        now = datetime.datetime.now()
+        action_class = Task.actions.property.mapper.class_
+
+        with self.database.session() as session:
+            job = Job(name="job", status=list(JobStatus)[0], datacenter="dc", created_at=now, updated_at=now)
+            session.add(job)
+            session.flush()
+
+            for i in range(targets):
+                worker = Worker(target="worker-" + str(i), framework="framework", datacenter="dc", tags={},
+                                created_at=now, updated_at=now)
+                session.add(worker)
+                session.flush()
+
+                job_target = JobTarget(job_id=job.id, worker_id=worker.id)
+                session.add(job_target)
+                session.flush()
+
+                for j in range(tasks):
+                    task = Task(name="task-" + str(j), status=TaskStatus.PENDING, job_target_id=job_target.id,
+                                created_at=now, updated_at=now)
+                    task.actions.append(action_class(processor="processor", arguments={'n': j}))
+                    task.actions.append(action_class(processor="processor", arguments=None))
+                    session.add(task)
+
+            session.commit()
+            return job.id
+
+    def count(self, function):
+        query_count.reset()
+        function()
+        return query_count.queries()
+
+    def test_job(self):
+        controller = JobAPIController(self.database, None)
+
+        # The version, then the job, its targets and tasks, which its progress is counted from
+        self.assertEqual(self.count(lambda: controller.GET(str(self.job_id))), 4)
+
+        job_id = self.add_job(5, 20)
+        self.assertEqual(self.count(lambda: controller.GET(str(job_id))), 4)
+
+    def test_tasks(self):
+        controller = TaskAPIController(self.database)
+
+        # The page of tasks and their actions
+        self.assertEqual(self.count(lambda: controller.GET()), 2)
+
+        self.add_job(5, 20)
+        self.assertEqual(self.count(lambda: controller.GET()), 2)
+        self.assertEqual(self.count(lambda: controller.GET(job_id=str(self.job_id))), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()